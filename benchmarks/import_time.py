@@ -0,0 +1,62 @@
+""" Measure how long it takes to import yahk.bot and what it drags in
+
+Runs `python -X importtime` in a fresh interpreter a few times and reports the
+best cumulative import time of yahk.bot, the slowest modules, and whether any
+service backends were imported eagerly (they should only load once configured).
+
+Usage: python benchmarks/import_time.py [runs] [module]
+"""
+import os
+import subprocess
+import sys
+
+# Modules that should only be imported when a service using them is configured
+lazy_modules = [
+    'yahk.services.irc', 'yahk.services.slack', 'yahk.db.irc', 'yahk.db.slack',
+    'aiohttp', 'websockets', 'asyncirc'
+]
+
+def run_once(target):
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', 'import {0}'.format(target)],
+        cwd=root, stderr=subprocess.PIPE, stdout=subprocess.DEVNULL, universal_newlines=True
+    )
+
+    if result.returncode != 0:
+        print(result.stderr.splitlines()[-1] if result.stderr else 'import failed')
+        sys.exit(1)
+
+    modules = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        head, cumulative_us, name = line.split('|', 2)
+        modules[name.strip()] = (int(head.split(':')[1]), int(cumulative_us))
+
+    return modules
+
+def main(runs=5, target='yahk.bot'):
+    best = None
+
+    for _ in range(runs):
+        modules = run_once(target)
+        if best is None or modules[target][1] < best[target][1]:
+            best = modules
+
+    print("{0}: {1:.1f}ms cumulative (best of {2})".format(target, best[target][1] / 1000, runs))
+
+    print("\nSlowest modules (self time):")
+    for name, (self_us, _) in sorted(best.items(), key=lambda x: x[1][0], reverse=True)[:10]:
+        print("  {0:>8.1f}ms  {1}".format(self_us / 1000, name))
+
+    eager = [name for name in lazy_modules if name in best]
+    print("\nEagerly imported backends: {0}".format(', '.join(eager) or 'none'))
+
+    return 1 if eager else 0
+
+if __name__ == '__main__':
+    sys.exit(main(
+        int(sys.argv[1]) if len(sys.argv) > 1 else 5,
+        sys.argv[2] if len(sys.argv) > 2 else 'yahk.bot'
+    ))
@@ -0,0 +1,84 @@
+""" Compare Slack API call latency with and without a persistent HTTP session
+
+Starts a local stand-in for the Slack Web API and times the same number of
+sequential calls two ways: opening a new aiohttp.ClientSession per call (what
+SlackAPI.api_call used to do) and SlackAPI._post, the HTTP request underneath
+api_call, on its one pooled session.  _post is timed rather than api_call so
+that neither the response cache nor the rate limiter gets in the way - only
+the connection handling differs.  Against slack.com the gap is larger still,
+since every new connection there also pays for a TLS handshake.
+
+Usage: PYTHONPATH=. python benchmarks/slack_api.py [calls]
+"""
+import asyncio
+import logging
+import statistics
+import sys
+import time
+from types import SimpleNamespace
+
+import aiohttp
+from aiohttp import web
+
+from yahk.services.slack import Slack
+
+async def fake_api(request):
+    await request.post()
+    return web.json_response({'ok': True, 'user': {'id': 'U000', 'name': 'bench'}})
+
+async def start_server():
+    app = web.Application()
+    app.router.add_post('/api/{method}', fake_api)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, '127.0.0.1', 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    return runner, 'http://127.0.0.1:{0}/api/{{0}}'.format(port)
+
+async def call_with_new_session(api_url, method, data):
+    async with aiohttp.ClientSession() as session:
+        form = aiohttp.FormData(data)
+        form.add_field('token', 'xoxb-bench')
+        async with session.post(api_url.format(method), data=form) as response:
+            return await response.json()
+
+async def time_calls(call, calls):
+    timings = []
+
+    for _ in range(calls):
+        start = time.perf_counter()
+        await call()
+        timings.append(time.perf_counter() - start)
+
+    return timings
+
+def report(name, timings):
+    timings = sorted(timings)
+    print("{0:<20} mean {1:7.3f}ms  p50 {2:7.3f}ms  p99 {3:7.3f}ms".format(
+        name,
+        statistics.mean(timings) * 1000,
+        timings[len(timings) // 2] * 1000,
+        timings[int(len(timings) * 0.99)] * 1000
+    ))
+
+async def main(calls):
+    runner, api_url = await start_server()
+    data = {'user': 'U000'}
+
+    service = SimpleNamespace(id='Slack/bench', logger=logging.getLogger('bench'))
+    api = Slack.SlackAPI(service, 'xoxb-bench', api_url=api_url)
+
+    try:
+        before = await time_calls(lambda: call_with_new_session(api_url, 'users.info', data), calls)
+        after = await time_calls(lambda: api._post('users.info', data), calls)
+    finally:
+        await api.close()
+        await runner.cleanup()
+
+    report('session per call', before)
+    report('pooled session', after)
+    print("speedup: {0:.1f}x".format(statistics.mean(before) / statistics.mean(after)))
+
+if __name__ == '__main__':
+    asyncio.run(main(int(sys.argv[1]) if len(sys.argv) > 1 else 500))
@@ -0,0 +1,119 @@
+""" Replay recorded Slack Events API payloads against the local events server
+
+Starts Slack.EventsServer on a free local port in front of a stand-in service
+that just records what reaches receive(), then POSTs the payloads to it -
+one envelope per request, as Slack itself sends them, and again batched the
+way a relay would.  Requests are signed, so signature checking is exercised
+too.  Each line of the payloads file is one Events API envelope; without a
+file, a synthetic mix of messages and typing notifications is generated.
+
+Usage: PYTHONPATH=. python benchmarks/slack_events.py [payloads.jsonl] [batch size]
+"""
+import asyncio
+import collections
+import hashlib
+import hmac
+import json
+import logging
+import sys
+import time
+from types import SimpleNamespace
+
+import aiohttp
+
+from yahk.services.slack import Slack
+
+signing_secret = 'bench-secret'
+
+def synthetic_payloads(count=2000):
+    payloads = []
+
+    for i in range(count):
+        if i % 4 == 3:
+            event = {'type': 'user_typing', 'channel': 'C000', 'user': 'U000'}
+        else:
+            event = {'type': 'message', 'channel': 'C000', 'user': 'U000', 'text': 'message {0}'.format(i),
+                     'ts': '{0}.000000'.format(1500000000 + i)}
+
+        payloads.append({'type': 'event_callback', 'event_id': 'Ev{0:08d}'.format(i), 'event': event})
+
+    return payloads
+
+def load_payloads(path):
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+def stand_in_service():
+    received = []
+
+    async def receive(event):
+        received.append(event)
+
+    service = SimpleNamespace(
+        id='Slack/bench',
+        logger=logging.getLogger('bench'),
+        ignore_frames=set(Slack.default_ignore_frames),
+        conn=SimpleNamespace(frame_counts=collections.Counter(), frames_dropped=collections.Counter()),
+        receive=receive,
+        is_echo=lambda event: False,
+        echoes=0
+    )
+
+    return service, received
+
+def sign(body):
+    timestamp = str(int(time.time()))
+    basestring = b'v0:' + timestamp.encode('ascii') + b':' + body
+    signature = 'v0=' + hmac.new(signing_secret.encode('utf-8'), basestring, hashlib.sha256).hexdigest()
+
+    return {'X-Slack-Request-Timestamp': timestamp, 'X-Slack-Signature': signature,
+            'Content-Type': 'application/json'}
+
+async def replay(payloads, batch_size):
+    service, received = stand_in_service()
+    server = Slack.EventsServer(service, port=0, signing_secret=signing_secret)
+    await server.start()
+
+    url = 'http://127.0.0.1:{0}{1}'.format(server.port, server.path)
+    expected = sum(1 for p in payloads if p['event']['type'] not in service.ignore_frames)
+
+    try:
+        async with aiohttp.ClientSession() as session:
+            start = time.perf_counter()
+
+            for i in range(0, len(payloads), batch_size):
+                batch = payloads[i:i + batch_size]
+                body = json.dumps(batch[0] if batch_size == 1 else batch).encode('utf-8')
+
+                async with session.post(url, data=body, headers=sign(body)) as response:
+                    assert response.status == 200, response.status
+
+            while len(received) < expected:
+                await asyncio.sleep(0.001)
+
+            elapsed = time.perf_counter() - start
+
+            # Slack redelivering the first event must not reach the handlers twice
+            body = json.dumps(payloads[0]).encode('utf-8')
+            async with session.post(url, data=body, headers=sign(body)) as response:
+                assert response.status == 200
+
+            async with session.post(url, data=body) as response:
+                assert response.status == 401
+    finally:
+        await server.stop()
+
+    assert len(received) == expected, (len(received), expected)
+
+    print("batch {0:<4} {1:5} events in {2:6.3f}s  {3:8.0f} events/s  ({4} dropped, {5} duplicates, {6} rejected)".format(
+        batch_size, len(payloads), elapsed, len(payloads) / elapsed,
+        sum(service.conn.frames_dropped.values()), server.stats['duplicates'], server.stats['rejected']
+    ))
+
+async def main(payloads, batch_size):
+    await replay(payloads, 1)
+    await replay(payloads, batch_size)
+
+if __name__ == '__main__':
+    payloads = load_payloads(sys.argv[1]) if len(sys.argv) > 1 else synthetic_payloads()
+    asyncio.run(main(payloads, int(sys.argv[2]) if len(sys.argv) > 2 else 50))
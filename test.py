@@ -1,4 +1,7 @@
-from yahk import b
+# Shard workers are spawned processes, which re-import this module - only
+# start the bot when it's run directly
+if __name__ == '__main__':
+    from yahk import b
 
-b.setup()
-b.start()
+    b.setup()
+    b.start()
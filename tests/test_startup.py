@@ -0,0 +1,72 @@
+""" Startup smoke tests - build the bot from a config, without connecting anything """
+import pytest
+
+pytest.importorskip('sqlalchemy')
+pytest.importorskip('yaml')
+pytest.importorskip('asyncirc')
+pytest.importorskip('aiohttp')
+pytest.importorskip('websockets')
+
+config = """
+main:
+  source_format: short
+irc:
+  testnet:
+    enabled: false
+    hosts: [['irc.invalid', 6667, false]]
+    nick: yahk
+    real_name: yahk
+    channels: ['#test']
+slack:
+  team:
+    enabled: false
+    token: xoxb-none
+    channels: ['general']
+"""
+
+@pytest.fixture
+def workdir(tmp_path, monkeypatch):
+    (tmp_path / 'config.yml').write_text(config)
+    monkeypatch.chdir(tmp_path)
+    return tmp_path
+
+def test_setup_with_services(workdir):
+    from yahk.bot import Bot
+
+    bot = Bot()
+    bot.setup()
+
+    assert sorted(bot.services) == ['IRC/testnet', 'Slack/team']
+    assert all(service.db_id for service in bot.services.values())
+
+@pytest.mark.parametrize('shard, services', [('a', ['IRC/testnet']), ('default', ['Slack/team'])])
+def test_setup_shard_worker(workdir, shard, services):
+    from yahk.bot import Bot
+
+    (workdir / 'config.yml').write_text(config.replace('main:\n', "main:\n  shards: {a: ['IRC/testnet']}\n"))
+
+    bot = Bot(shard=shard)
+    bot.setup()
+
+    assert sorted(bot.services) == services
+    assert (workdir / 'yahk-{0}.db'.format(shard)).exists()
+
+def test_restart_in_running_loop(workdir):
+    import asyncio
+    from yahk.bot import Bot
+
+    bot = Bot()
+    bot.setup()
+
+    async def restart():
+        bot.loop = asyncio.get_event_loop()
+        await bot.start_up()
+        old = dict(bot.services)
+
+        await bot.restart()
+        assert sorted(bot.services) == sorted(old)
+        assert all(bot.services[service_id] is not old[service_id] for service_id in old)
+
+        await bot.shut_down()
+
+    asyncio.new_event_loop().run_until_complete(restart())
@@ -19,5 +19,13 @@ ch.setFormatter(short_formatter)
 logger.addHandler(fh)
 logger.addHandler(ch)
 
-from yahk.bot import Bot
-b = Bot()
\ No newline at end of file
+def __getattr__(name):
+    # Only construct the bot when it's actually asked for, so importing a
+    # submodule (plugins, pool workers, benchmarks) stays cheap
+    if name == 'b':
+        global b
+        from yahk.bot import Bot
+        b = Bot()
+        return b
+
+    raise AttributeError("module {0!r} has no attribute {1!r}".format(__name__, name))
\ No newline at end of file
@@ -0,0 +1,6 @@
+# python -m yahk - guarded, as shard worker processes re-import the main module
+if __name__ == '__main__':
+    from yahk import b
+
+    b.setup()
+    b.start()
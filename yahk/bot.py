@@ -2,42 +2,133 @@ import logging
 import asyncio
 import collections
 import argparse
+import importlib
 import importlib.util
 import inspect
+import multiprocessing
 import os
-from expiringdict import ExpiringDict
-from aioconsole import AsynchronousCli, start_interactive_server
-from aioconsole.server import parse_server, print_server
+import sys
+import time
+import json
+from concurrent.futures import ProcessPoolExecutor
+from yahk.bus import Coordinator, ShardClient, ShardWorker
 from yahk.console import Console
 from yahk.config import Config
 #from yahk.bridge import Bridge
 from yahk.db import DB
+from yahk.dedupe import Deduplicator
+from yahk.dispatch import Dispatcher
+from yahk.events import EventBus
+from yahk.relay import BridgeGraph
+from yahk.scheduler import Scheduler
 from yahk.services import Bridge
-from yahk.services.irc import IRC
 from yahk.plugin import Plugin
-#from yahk.services.discord import Discord
-from yahk.services.slack import Slack
-#from yahk.services.telegram import Telegram
 
 logger = logging.getLogger(__name__)
 
+# Service backends, keyed by config section - each is only imported (along
+# with its protocol library and DB models) if that section is configured
+service_classes = {
+    'irc': ('yahk.services.irc', 'IRC'),
+    'slack': ('yahk.services.slack', 'Slack'),
+    #'discord': ('yahk.services.discord', 'Discord'),
+    #'telegram': ('yahk.services.telegram', 'Telegram'),
+}
+
+# DB models for each backend - cheap to import, but they have to be
+# registered before DB() creates the tables
+service_models = {
+    'irc': 'yahk.db.irc',
+    'slack': 'yahk.db.slack',
+}
+
 class Bot(object):
 
-    """ Main bot object """
-    def __init__(self):
+    """ Main bot object
+
+    With shards configured this is either the coordinator (shard is None),
+    which runs no services itself but spawns a worker process per shard and
+    routes bridge traffic between them, or one of those workers.
+    """
+    def __init__(self, shard=None):
+        # A spawned shard worker re-imports the launcher script - if that
+        # isn't guarded by __name__ == '__main__' it would end up here,
+        # starting a second coordinator (and resetting the database)
+        if shard is None and multiprocessing.current_process().name != 'MainProcess':
+            raise RuntimeError("The bot was started from a child process - run it from a script "
+                               "guarded by if __name__ == '__main__' (or with python -m yahk)")
+
+        self.shard = shard
+        self.configure()
+
+    def configure(self):
+        """ Load the configuration and set up fresh bot state - also used by restart() """
         self.services = {}
         self.bridges = {}
 
-        self.recent = ExpiringDict(max_len=100, max_age_seconds=1)
-
         self.prefix = '.'
+        self.plugin_manifest = 'plugins.json'
 
+        self.plugins = {}
         self.commands = {}
         self.matches = {}
 
         self.load_config()
+        main = self.config.config['main']
+
+        # Compiled command/match lookup, rebuilt whenever plugins are loaded
+        self.dispatcher = Dispatcher(self)
+
+        # Plugin handlers run as supervised tasks, off the receive path
+        self.scheduler = Scheduler(
+            timeout=main['plugin_timeout'] if 'plugin_timeout' in main else 30,
+            concurrency=main['plugin_concurrency'] if 'plugin_concurrency' in main else 4,
+            backlog=main['plugin_backlog'] if 'plugin_backlog' in main else 256
+        )
+
+        # Process pool for @cpu_bound plugin handlers, created on first use
+        self.cpu_workers = main['cpu_workers'] if 'cpu_workers' in main else None
+        self._process_pool = None
+
+        # Duplicate/loop suppression
+        self.recent = Deduplicator(
+            window=main['dedupe_window'] if 'dedupe_window' in main else 1,
+            capacity=main['dedupe_capacity'] if 'dedupe_capacity' in main else 100000
+        )
+
+        # Per-event persistence policies and in-memory event subscribers
+        self.events = EventBus(
+            default=main['event_policy'] if 'event_policy' in main else 'persist',
+            policies=main['event_policies'] if 'event_policies' in main else None
+        )
 
-        self.db = DB()
+        # Bridge membership, and how far relayed messages may travel
+        self.bridge_graph = BridgeGraph(self)
+        self.max_hops = main['max_hops'] if 'max_hops' in main else 3
+
+        # Worker processes, each running a group of services - shard name ->
+        # list of service ids, with unlisted services in the default shard
+        self.shards = main['shards'] if 'shards' in main else None
+        self.bus_path = main['bus_path'] if 'bus_path' in main else 'yahk.sock'
+        self.coordinator = None
+        self.shard_client = None
+        self.workers = {}
+
+        self.load_db_models()
+
+        # Each worker keeps its own database, as they would otherwise drop each other's tables
+        if self.shard is not None:
+            self.db = DB('sqlite:///yahk-{0}.db'.format(self.shard))
+        else:
+            self.db = DB()
+
+        # Hand chat/user/message/event writes to a separate writer process
+        self.db_writer = main['db_writer'] if 'db_writer' in main else False
+        self.db_batch_size = main['db_batch_size'] if 'db_batch_size' in main else 500
+        self.db_linger = main['db_linger'] if 'db_linger' in main else 0.05
+
+        # Background tasks started by start_up(), cancelled by shut_down()
+        self.tasks = []
 
     def load_config(self):
         # Load config
@@ -69,11 +160,15 @@ class Bot(object):
             if service == 'irc':
                 for service_name in self.config.config['irc']:
                     service_id = "IRC/{0}".format(service_name)
+
+                    if not self.runs_service(service_id):
+                        continue
+
                     logger.debug("Configuring {0}...".format(service_id))
                     service_details = self.config.config['irc'][service_name]
 
                     # Configure IRC connection
-                    i = IRC(
+                    i = self.get_service_class('irc')(
                         bot=self,
                         id=service_id,
                         name=service_name,
@@ -81,9 +176,11 @@ class Bot(object):
                         hosts=service_details['hosts'],
                         nick=service_details['nick'],
                         real_name=service_details['real_name'],
-                        channels=service_details['channels']
+                        channels=service_details['channels'],
+                        join_batch=service_details['join_batch'] if 'join_batch' in service_details else 10
                     )
 
+                    i.source_format = service_details['source_format'] if 'source_format' in service_details else None
                     self.services[service_id] = i
 
             # if service == 'discord':
@@ -109,19 +206,32 @@ class Bot(object):
             if service == 'slack':
                 for service_name in self.config.config['slack']:
                     service_id = "Slack/{0}".format(service_name)
+
+                    if not self.runs_service(service_id):
+                        continue
+
                     logger.debug("Configuring {0}".format(service_id))
                     service_details = self.config.config['slack'][service_name]
 
                     # Configure Discord connection
-                    s = Slack(
+                    s = self.get_service_class('slack')(
                         bot=self,
                         id=service_id,
                         name=service_name,
                         enabled=service_details['enabled'] if 'enabled' in service_details else True,
                         token=service_details['token'],
-                        channels=service_details['channels']
+                        channels=service_details['channels'],
+                        api_url=service_details['api_url'] if 'api_url' in service_details else None,
+                        ignore_frames=service_details['ignore_frames'] if 'ignore_frames' in service_details else None,
+                        ingest=service_details['ingest'] if 'ingest' in service_details else 'rtm',
+                        events_host=service_details['events_host'] if 'events_host' in service_details else '127.0.0.1',
+                        events_port=service_details['events_port'] if 'events_port' in service_details else 3000,
+                        events_path=service_details['events_path'] if 'events_path' in service_details else None,
+                        signing_secret=service_details['signing_secret'] if 'signing_secret' in service_details else None,
+                        lazy_chats=service_details['lazy_chats'] if 'lazy_chats' in service_details else False
                     )
 
+                    s.source_format = service_details['source_format'] if 'source_format' in service_details else None
                     self.services[service_id] = s
             #
             # if service == 'telegram':
@@ -141,24 +251,144 @@ class Bot(object):
             #
             #         self.services[service_id] = t
 
+        # Services are constructed without touching the database - save them
+        # all in one transaction, rather than a commit each.  The database was
+        # only just created, so there are no rows to look up first.
+        services = list(self.services.values())
+        db_objects = [service.db_object(lookup=False) for service in services]
+
+        for service, db_id in zip(services, self.db.store_all(db_objects)):
+            service.db_id = db_id
+
+    def service_ids(self):
+        """ Every configured service id, without setting the services up """
+        ids = []
+
+        for section, (module_name, class_name) in service_classes.items():
+            if section in self.config.config:
+                ids.extend("{0}/{1}".format(class_name, name) for name in self.config.config[section])
+
+        return ids
+
+    def shard_of(self, service_id):
+        for shard, service_ids in self.shards.items():
+            if service_id in service_ids:
+                return shard
+
+        return 'default'
+
+    def runs_service(self, service_id):
+        if not self.shards:
+            return True
+
+        # The coordinator leaves every service to the workers
+        return self.shard is not None and self.shard_of(service_id) == self.shard
+
+    def start_shards(self):
+        """ Start a worker process for every shard with services in it, restarting any that exit """
+        for shard in sorted({self.shard_of(service_id) for service_id in self.service_ids()}):
+            logger.info("Starting shard {0}...".format(shard))
+            worker = ShardWorker(shard, run_shard)
+            worker.start()
+            self.workers[shard] = worker
+
+    def stop_shards(self):
+        for worker in self.workers.values():
+            worker.stop()
+
+        for worker in self.workers.values():
+            if worker.process:
+                worker.process.join(5)
+
+        self.workers = {}
+
+    def load_db_models(self):
+        for section, module_name in service_models.items():
+            if section in self.config.config:
+                importlib.import_module(module_name)
+
+    def get_service_class(self, section):
+        module_name, class_name = service_classes[section]
+        start = time.monotonic()
+        module = importlib.import_module(module_name)
+        logger.debug("Loaded {0} backend in {1:.1f}ms".format(
+            section, (time.monotonic() - start) * 1000
+        ))
+        return getattr(module, class_name)
+
     def start(self):
         # Init event loop
         logger.debug("Initialising event loop...")
         self.loop = asyncio.get_event_loop()
+        self.loop.run_until_complete(self.start_up())
 
-        # Create and start all tasks
-        for service_id, service in self.services.items():
-            logger.debug("Starting task for {0}...".format(service_id))
-            self.loop.create_task(service.start())
-
-        server = self.loop.create_server(
-            self.console.create_server, '192.168.16.28', 8001
-        )
-        self.loop.server = self.loop.run_until_complete(server)
+        # The console is the coordinator's, and stays up across restarts
+        if self.shard is None:
+            server = self.loop.create_server(
+                lambda: self.console.create_server(), '192.168.16.28', 8001
+            )
+            self.loop.server = self.loop.run_until_complete(server)
 
 
         self.loop.run_forever()
 
+    async def start_up(self):
+        """ Start the database writer, shards and services, in the running loop """
+        # The coordinator has no services, so nothing to write
+        if self.db_writer and not (self.shards and self.shard is None):
+            self.db.start_writer(batch_size=self.db_batch_size, linger=self.db_linger)
+
+        if self.shards and self.shard is None:
+            self.coordinator = Coordinator(self, self.bus_path)
+            await self.coordinator.start()
+            self.start_shards()
+        elif self.shard is not None:
+            self.shard_client = ShardClient(self, self.shard, self.bus_path)
+            self.shard_client.start()
+
+        # Connect services concurrently
+        self.tasks.append(self.loop.create_task(self.bring_up()))
+
+        # Pick up plugin changes without restarting
+        if 'plugin_reload_interval' in self.config.config['main']:
+            self.tasks.append(self.loop.create_task(self.watch_plugins(
+                self.config.config['main']['plugin_reload_interval']
+            )))
+
+    async def bring_up(self):
+        """ Start all services, with at most startup_concurrency connecting at once """
+        main = self.config.config['main']
+        concurrency = main['startup_concurrency'] if 'startup_concurrency' in main else 4
+        timeout = main['startup_timeout'] if 'startup_timeout' in main else 120
+
+        start = time.monotonic()
+        semaphore = asyncio.Semaphore(concurrency)
+
+        await asyncio.gather(*[
+            self._bring_up_service(service, semaphore, timeout) for service in self.services.values()
+        ])
+
+        ready = [service for service in self.services.values() if service.ready_time is not None]
+        logger.info("{0}/{1} services ready in {2:.1f}s".format(
+            len(ready), len(self.services), time.monotonic() - start
+        ))
+
+    async def _bring_up_service(self, service, semaphore, timeout):
+        async with semaphore:
+            logger.debug("Starting task for {0}...".format(service.id))
+            service.mark_starting()
+            self.loop.create_task(service.start())
+
+            if not service.enabled:
+                return
+
+            # Hold our slot until the service is ready (or gives up), so
+            # connections and channel joins are spread out rather than all at once
+            try:
+                await asyncio.wait_for(service.ready_event.wait(), timeout)
+            except asyncio.TimeoutError:
+                logger.warning("{0} not ready after {1}s, continuing".format(service.id, timeout))
+
     async def handle_message(self, message, service, context):
         logger.debug("MSG {0}: {1}".format(service.id, message))
 
@@ -173,6 +403,45 @@ class Bot(object):
             self.bridges[bridge.name] = bridge
             return bridge
 
+    def rename_bridge(self, bridge, name):
+        """ Give bridge a name, merging it into any bridge that already has it """
+        other = self.bridges.get(name)
+
+        if other is not None and other is not bridge:
+            logger.info("Merging bridge {0} into {1}".format(bridge.name, name))
+
+            for bridge_chat in list(bridge.bridge_chats.values()):
+                bridge.remove_bridge_chat(bridge_chat)
+                bridge_chat.bridge = other
+                bridge_chat.save()
+                other.add_bridge_chat(bridge_chat)
+
+            for member in list(bridge.members):
+                other.add(member)
+
+            self.delete_bridge(bridge)
+            return other
+
+        if self.bridges.get(bridge.name) is bridge:
+            del self.bridges[bridge.name]
+
+        bridge._name = name
+        bridge.named = True
+        self.bridges[name] = bridge
+        bridge.save()
+
+        # Report any cycle the new name closes right away
+        self.update_bridge_graph()
+        self.bridge_graph.check()
+        return bridge
+
+    def update_bridge_graph(self):
+        """ Mark the bridge graph for rebuilding after membership changes """
+        self.bridge_graph.invalidate()
+
+        if self.shard_client:
+            self.shard_client.schedule_announce()
+
     def delete_bridge(self, bridge):
         name = bridge.name
 
@@ -180,21 +449,70 @@ class Bot(object):
             logger.debug("Deleting bridge {0}...".format(name))
             del self.bridges[name]
             del bridge
+            self.update_bridge_graph()
             logger.debug("Bridge {0} deleted".format(name))
             return True
         else:
             logger.error("Bridge {0} does not exist!".format(name))
             return False
 
-    async def quit(self):
+    @property
+    def process_pool(self):
+        if not self._process_pool:
+            # Workers are forked so they inherit the already-loaded plugin modules
+            logger.debug("Starting process pool ({0} workers)...".format(
+                self.cpu_workers or os.cpu_count()
+            ))
+            # ... which includes the database writer's end of its pipe - closed
+            # again, or the writer would never see us exit
+            inherited = []
+
+            if self.db.writer and self.db.writer.conn:
+                inherited.append(self.db.writer.conn.fileno())
+
+            self._process_pool = ProcessPoolExecutor(
+                max_workers=self.cpu_workers,
+                mp_context=multiprocessing.get_context('fork'),
+                initializer=close_inherited,
+                initargs=(inherited,)
+            )
+
+        return self._process_pool
+
+    def shutdown_process_pool(self, cancel=False):
+        """ Retire the process pool - calls already queued still run, unless cancel is set """
+        if self._process_pool:
+            logger.debug("Shutting down process pool...")
+            self._process_pool.shutdown(wait=False, cancel_futures=cancel)
+            self._process_pool = None
+
+    async def shut_down(self):
+        """ Stop everything start_up() started, leaving the event loop running """
+        for task in self.tasks:
+            task.cancel()
+
+        await self.scheduler.shutdown()
+        self.shutdown_process_pool(cancel=True)
+
         for service_name, service in self.services.items():
             logger.debug("Requesting quit from {0}...".format(service_name))
             await service.quit()
             del service
 
+        if self.shard_client:
+            self.shard_client.close()
+
+        if self.coordinator:
+            self.stop_shards()
+            await self.coordinator.stop()
+
+        self.db.close()
+
+    async def quit(self):
+        await self.shut_down()
         self.loop.stop()
 
-    def load_plugins(self):
+    def find_plugins(self):
         plugins = {}
         root_dir = os.path.dirname(os.path.abspath(__file__))
         plugin_dir = os.path.join(root_dir, 'plugins')
@@ -204,53 +522,270 @@ class Bot(object):
 
             if os.path.isfile(plugin_path) and plugin_path.endswith('.py'):
                 name = os.path.basename(plugin_path)[:-3]
-
-                logger.debug("Found plugin {0} ({1})".format(name, plugin_path))
                 plugins[name] = plugin_path
 
-        commands = []
-        for plugin_name in plugins:
-            plugin_path = plugins[plugin_name]
+        return plugins
+
+    def load_plugin(self, plugin_name, plugin_path):
+        """ Import a plugin module and return the commands and matches it provides """
+        commands = {}
+        matches = {}
+        cpu_bound = False
+
+        mtime = os.stat(plugin_path).st_mtime
+
+        # Register under a stable name so pool workers can resolve handlers
+        module_name = 'yahk.plugins.{0}'.format(plugin_name)
+        module_spec = importlib.util.spec_from_file_location(module_name, plugin_path)
+        module = importlib.util.module_from_spec(module_spec)
+        module_spec.loader.exec_module(module)
+        sys.modules[module_name] = module
+
+        for obj in dict.values(vars(module)):
+            if inspect.isclass(obj) and issubclass(obj, Plugin) and obj != Plugin:
+                obj_name = obj.__name__
+                i = obj(self)
+
+                for o_name in dir(i):
+                    o = getattr(i, o_name)
+                    if callable(o):
+                        if hasattr(o, 'cpu_bound'):
+                            cpu_bound = True
+                        if hasattr(o, 'commands'):
+                            for command in o.commands:
+                                logger.debug("Registering {0}.{1} for command {2}".format(
+                                    obj_name, o_name, command
+                                ))
+                                commands[command] = o
+                        if hasattr(o, 'matches'):
+                            for match in o.matches:
+                                logger.debug("Registering {0}.{1} for match {2}".format(
+                                    obj_name, o_name, match
+                                ))
+                                matches[match] = o
+
+        self.plugins[plugin_name] = {
+            'path': plugin_path,
+            'mtime': mtime,
+            'commands': list(commands),
+            'matches': list(matches),
+            'cpu_bound': cpu_bound,
+            'loaded': True
+        }
+
+        return commands, matches
 
-            try:
-                module_spec = importlib.util.spec_from_file_location(plugin_name, plugin_path)
-                module = importlib.util.module_from_spec(module_spec)
-                module_spec.loader.exec_module(module)
-
-                for obj in dict.values(vars(module)):
-                    if inspect.isclass(obj) and issubclass(obj, Plugin) and obj != Plugin:
-                        obj_name = obj.__name__
-                        i = obj(self)
-
-                        for o_name in dir(i):
-                            o = getattr(i, o_name)
-                            if callable(o):
-                                if hasattr(o, 'commands'):
-                                    #logger.debug("Plugin {0} has function {1} with commands {2}".format(
-                                    #    plugin_name, o.__name__, o.commands
-                                    #))
-
-                                    for command in o.commands:
-                                        logger.debug("Registering {0}.{1} for command {2}".format(
-                                            obj_name, o_name, command
-                                        ))
-                                        self.commands[command] = o
-                                if hasattr(o, 'matches'):
-
-                                    for match in o.matches:
-                                        logger.debug("Registering {0}.{1} for match {2}".format(
-                                            obj_name, o_name, match
-                                        ))
-                                        self.matches[match] = o
+    def load_plugins(self):
+        main = self.config.config['main']
+
+        # Command aliases
+        if 'aliases' in main:
+            self.dispatcher.aliases.update(main['aliases'])
+
+        self.plugin_manifest = main['plugin_manifest'] if 'plugin_manifest' in main else 'plugins.json'
+
+        if 'lazy_plugins' in main and not main['lazy_plugins']:
+            self.reload_plugins(force=True)
+            return
+
+        # Plugins unchanged since the manifest was written get placeholder
+        # handlers, and are only imported the first time one of them is used
+        manifest = self.read_plugin_manifest()
+        found = self.find_plugins()
+
+        for plugin_name, plugin_path in found.items():
+            entry = manifest.get(plugin_name)
+
+            if entry and entry['path'] == plugin_path and entry['mtime'] == os.stat(plugin_path).st_mtime:
+                logger.debug("Deferring plugin {0} ({1})".format(plugin_name, plugin_path))
+                self.plugins[plugin_name] = dict(entry, loaded=False)
+
+                for command in entry['commands']:
+                    self.commands[command] = self._lazy_handler(plugin_name, 'commands', command)
 
+                for match in entry['matches']:
+                    self.matches[match] = self._lazy_handler(plugin_name, 'matches', match)
+
+        if not self.reload_plugins():
+            self.dispatcher.compile()
+
+    def read_plugin_manifest(self):
+        try:
+            with open(self.plugin_manifest, 'r') as f:
+                return json.load(f)
+        except (OSError, ValueError) as e:
+            logger.debug("No usable plugin manifest ({0}), loading all plugins".format(e))
+            return {}
+
+    def write_plugin_manifest(self):
+        manifest = {}
+
+        for plugin_name, plugin in self.plugins.items():
+            manifest[plugin_name] = {
+                'path': plugin['path'],
+                'mtime': plugin['mtime'],
+                'commands': plugin['commands'],
+                'matches': plugin['matches'],
+                'cpu_bound': plugin.get('cpu_bound', False)
+            }
+
+        try:
+            with open(self.plugin_manifest, 'w') as f:
+                json.dump(manifest, f, indent=2)
+        except OSError as e:
+            logger.warning("Could not write plugin manifest: {0}".format(e))
+
+    def _lazy_handler(self, plugin_name, registry, key):
+        # registry is the name of the attribute ('commands' or 'matches'), as
+        # the dicts themselves are replaced on every reload
+        def resolve():
+            plugin = self.plugins.get(plugin_name)
+
+            if plugin and not plugin['loaded']:
+                self.reload_plugins(names=[plugin_name])
+
+            handler = getattr(self, registry).get(key)
+
+            if handler and not hasattr(handler, 'lazy'):
+                return handler
+
+            logger.error("Plugin {0} no longer provides {1}".format(plugin_name, key))
+            return None
+
+        async def load_and_call(*args):
+            handler = resolve()
+
+            if handler:
+                await handler(*args)
+
+        load_and_call.lazy = True
+        load_and_call.resolve = resolve
+        load_and_call.__module__ = 'yahk.plugins.{0}'.format(plugin_name)
+        load_and_call.__name__ = key
+        return load_and_call
+
+    def resolve_handler(self, handler):
+        """ The plugin's own bound method for handler, loading the plugin first if handler is a placeholder """
+        if hasattr(handler, 'lazy'):
+            return handler.resolve()
+
+        return handler
+
+    def reload_plugins(self, force=False, names=None):
+        """ Re-import plugins whose files changed since they were loaded
+
+        The new handlers are swapped into bot.commands and bot.matches in one
+        go; calls already in flight hold their own references and finish on
+        the old code.  Services and connections are never touched.
+        """
+        start = time.monotonic()
+        found = self.find_plugins()
+
+        changed = []
+        for plugin_name, plugin_path in found.items():
+            known = self.plugins.get(plugin_name)
+            if names is not None:
+                if plugin_name in names:
+                    changed.append(plugin_name)
+            elif force or not known or known['path'] != plugin_path or \
+                    known['mtime'] != os.stat(plugin_path).st_mtime:
+                changed.append(plugin_name)
+
+        removed = [name for name in self.plugins if name not in found]
+
+        if not changed and not removed:
+            return []
+
+        commands = dict(self.commands)
+        matches = dict(self.matches)
+
+        # Whether pool workers (forked with the old modules) need replacing
+        recycle_pool = False
+
+        for plugin_name in removed:
+            logger.info("Unloading plugin {0}".format(plugin_name))
+            recycle_pool = recycle_pool or self.plugins[plugin_name].get('cpu_bound', False)
+            self._unregister_plugin(plugin_name, commands, matches)
+            del self.plugins[plugin_name]
+            sys.modules.pop('yahk.plugins.{0}'.format(plugin_name), None)
+
+        for plugin_name in changed:
+            logger.debug("Loading plugin {0} ({1})".format(plugin_name, found[plugin_name]))
+            previous = self.plugins.get(plugin_name)
+
+            try:
+                new_commands, new_matches = self.load_plugin(plugin_name, found[plugin_name])
             except Exception as e:
+                # Keep whatever version was loaded before
                 logger.error("Could not load plugin {0}: {1}".format(plugin_name, e))
+                continue
+
+            if previous:
+                self._unregister_plugin(plugin_name, commands, matches, previous)
+
+            recycle_pool = recycle_pool or self.plugins[plugin_name]['cpu_bound'] or \
+                bool(previous and previous['loaded'] and previous.get('cpu_bound'))
+
+            commands.update(new_commands)
+            matches.update(new_matches)
+
+        self.commands = commands
+        self.matches = matches
+        self.dispatcher.compile()
+
+        # Pool workers were forked with the old modules - only replace them
+        # if a reloaded plugin runs anything there, and let queued calls finish
+        if recycle_pool:
+            self.shutdown_process_pool()
 
-        return
+        logger.info("Loaded {0} and unloaded {1} plugins in {2:.1f}ms".format(
+            changed, removed, (time.monotonic() - start) * 1000
+        ))
+
+        self.write_plugin_manifest()
+
+        return changed + removed
+
+    def _unregister_plugin(self, plugin_name, commands, matches, plugin=None):
+        plugin = plugin or self.plugins[plugin_name]
+
+        for command in plugin['commands']:
+            commands.pop(command, None)
+
+        for match in plugin['matches']:
+            matches.pop(match, None)
+
+    async def watch_plugins(self, interval):
+        logger.debug("Watching plugins for changes every {0}s".format(interval))
+
+        while True:
+            await asyncio.sleep(interval)
+            self.reload_plugins()
 
     async def restart(self):
+        """ Tear everything down and start again from the configuration, in the running loop
+
+        This cancels outstanding plugin calls, so run it as a task of its own
+        rather than awaiting it from a plugin handler.
+        """
         logger.debug("Restarting...")
-        self.quit()
-        self.load_config()
+        await self.shut_down()
+        self.configure()
         self.setup()
-        self.start()
+        await self.start_up()
+
+def close_inherited(fds):
+    """ Process pool initializer - close file descriptors forked from the bot """
+    for fd in fds:
+        try:
+            os.close(fd)
+        except OSError:
+            pass
+
+def run_shard(shard):
+    """ Entry point for a shard worker process """
+    import yahk
+
+    bot = yahk.b = Bot(shard=shard)
+    bot.setup()
+    bot.start()
@@ -54,9 +54,7 @@ class Bridge(object):
         await self.debugtools(text, chat, source)
 
     async def debugtools(self, text, chat, source):
-        recent_message = "{0}/{1}/{2}".format(source, chat.id, text)
-
-        if self.bot.recent.get(recent_message):
+        if self.bot.recent.seen(source, chat.id, text):
             logger.debug("Suppressed duplicate message")
         else:
             if text[0] == self.bot.prefix:
@@ -81,6 +79,4 @@ class Bridge(object):
             # elif text == ".restart":
             #     await self.bot.restart()
             # elif text == ".ping":
-            #     await self.send("pong!")
-
-            self.bot.recent[recent_message] = True
\ No newline at end of file
+            #     await self.send("pong!")
\ No newline at end of file
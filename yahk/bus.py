@@ -0,0 +1,441 @@
+import asyncio
+import collections
+import json
+import logging
+import multiprocessing
+import os
+import struct
+
+from yahk.relay import chat_key
+from yahk.render import compile_renderer, render_key
+from yahk.supervisor import Supervisor
+
+# Use a faster JSON codec for frames if one is installed
+try:
+    import orjson
+    dumps, loads = orjson.dumps, orjson.loads
+except ImportError:
+    dumps = lambda obj: json.dumps(obj, separators=(',', ':')).encode('utf-8')
+    loads = json.loads
+
+logger = logging.getLogger(__name__)
+
+# Frames are a 4-byte length and 1-byte kind, then the fields as a JSON array
+header = struct.Struct('!IB')
+
+HELLO = 1       # shard -> coordinator: [shard name]
+MEMBERS = 2     # shard -> coordinator: [[bridge name, service id, chat identifier], ...]
+RELAY = 3       # shard -> coordinator: [bridge, service id, chat identifier, service type, user, chat name, text, hops, [origin service id, origin chat identifier]]
+DELIVER = 4     # coordinator -> shard: [bridge, source service id, service type, user, chat name, text, hops, [origin service id, origin chat identifier], [[service id, chat identifier], ...]]
+ASSIGN = 5      # coordinator -> shard: [[bridge name, service id, chat identifier], ...] - memberships to restore
+ROUTES = 6      # coordinator -> shard: [[bridge name, service id, chat identifier], ...] - chats with members elsewhere
+
+max_frame = 1024 * 1024
+
+# Bytes waiting to be written to a peer before relayed messages for it are
+# dropped, rather than buffered without limit while it's stalled
+max_buffer = 1024 * 1024
+
+def encode(kind, fields):
+    payload = dumps(fields)
+    return header.pack(len(payload), kind) + payload
+
+async def read_frame(reader):
+    length, kind = header.unpack(await reader.readexactly(header.size))
+
+    if length > max_frame:
+        raise ValueError("Frame of {0} bytes is too large".format(length))
+
+    return kind, loads(await reader.readexactly(length))
+
+def congested(writer):
+    return writer.transport.get_write_buffer_size() > max_buffer
+
+class Coordinator(object):
+
+    """ Owns bridge membership across shards, and routes relayed messages between them
+
+    Shards announce which of their chats are in which named bridges, and the
+    coordinator keeps that, so a restarted shard is told (ASSIGN) which
+    bridges to put its chats back into.  Each shard is also told (ROUTES)
+    which of its chats have bridge members on other shards, and only relays
+    messages from those; a relayed message is forwarded, as one DELIVER frame
+    per destination shard, to every other shard with chats in that bridge.
+    Bridges are matched across shards by name.
+    """
+
+    def __init__(self, bot, path):
+        self.bot = bot
+        self.path = path
+        self.server = None
+
+        self.shards = {}
+        self.members = {}
+
+        # (bridge name, source chat key) -> ((shard name, (destination chat keys)), ...)
+        self.routes = {}
+
+        # Shard name -> its chats with routes, as last compiled and as last sent
+        self.sources = {}
+        self.sent_sources = {}
+
+        self.stats = collections.Counter()
+
+    async def start(self):
+        # Left behind by a previous run
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+        self.server = await asyncio.start_unix_server(self.handle, self.path)
+        logger.info("Coordinator listening on {0}".format(self.path))
+
+    async def stop(self):
+        if self.server:
+            self.server.close()
+            await self.server.wait_closed()
+            self.server = None
+
+    async def handle(self, reader, writer):
+        shard = None
+
+        try:
+            while True:
+                kind, fields = await read_frame(reader)
+                self.stats['frames in'] += 1
+
+                if kind == HELLO:
+                    shard = fields[0]
+                    self.shards[shard] = writer
+                    self.sent_sources.pop(shard, None)
+                    logger.info("Shard {0} connected".format(shard))
+
+                    if self.members.get(shard):
+                        writer.write(encode(ASSIGN, [[bridge, key[0], key[1]] for bridge, key in self.members[shard]]))
+
+                    self.compile()
+                elif kind == MEMBERS and shard:
+                    self.members[shard] = [(bridge, (service_id, identifier)) for bridge, service_id, identifier in fields]
+                    self.compile()
+                elif kind == RELAY and shard:
+                    self.relay(shard, fields)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        except ValueError as e:
+            logger.error("Bad frame from shard {0}: {1}".format(shard, e))
+        finally:
+            # Its memberships are kept, to hand back when it reconnects
+            if shard and self.shards.get(shard) is writer:
+                logger.warning("Shard {0} disconnected".format(shard))
+                del self.shards[shard]
+                self.compile()
+
+            writer.close()
+
+    def compile(self):
+        """ Rebuild the cross-shard routing table from connected shards' memberships """
+        bridges = {}
+
+        for shard, members in self.members.items():
+            if shard in self.shards:
+                for bridge, key in members:
+                    bridges.setdefault(bridge, []).append((shard, key))
+
+        routes = {}
+        sources = {}
+
+        for bridge, members in bridges.items():
+            for shard, key in members:
+                destinations = collections.OrderedDict()
+
+                # Chats on the source's own shard were already routed there
+                for other_shard, other_key in members:
+                    if other_shard != shard:
+                        destinations.setdefault(other_shard, []).append(other_key)
+
+                if destinations:
+                    routes[(bridge, key)] = tuple((s, tuple(keys)) for s, keys in destinations.items())
+                    sources.setdefault(shard, []).append([bridge, key[0], key[1]])
+
+        self.routes = routes
+        self.sources = sources
+
+        for shard, writer in self.shards.items():
+            shard_sources = sorted(sources.get(shard, []))
+
+            if self.sent_sources.get(shard) != shard_sources:
+                writer.write(encode(ROUTES, shard_sources))
+                self.sent_sources[shard] = shard_sources
+
+    def relay(self, shard, fields):
+        bridge, service_id, identifier, service_type, user_name, chat_name, text, hops, origin = fields
+        self.stats['relayed'] += 1
+
+        # Crossing to another shard counts as a hop
+        hops += 1
+
+        if hops > self.bot.max_hops:
+            self.stats['too far'] += 1
+            logger.debug("Not relaying message from {0}/{1}, it has made {2} hops".format(service_id, identifier, hops - 1))
+            return
+
+        routes = self.routes.get((bridge, (service_id, identifier)), ())
+        fields = [bridge, service_id, service_type, user_name, chat_name, text, hops, origin]
+
+        for destination, keys in routes:
+            writer = self.shards.get(destination)
+
+            if not writer:
+                continue
+
+            if congested(writer):
+                self.stats['dropped'] += 1
+                logger.debug("Shard {0} is not keeping up, dropped message for {1}".format(destination, bridge))
+                continue
+
+            writer.write(encode(DELIVER, fields + [keys]))
+            self.stats['delivered'] += 1
+
+class ShardWorker(object):
+
+    """ A shard worker process, started again with backoff whenever it exits """
+
+    def __init__(self, shard, target):
+        self.shard = shard
+        self.target = target
+        self.id = 'shard/{0}'.format(shard)
+        self.enabled = True
+
+        self.process = None
+        self.task = None
+        self.supervisor = Supervisor(self, max_delay=60)
+
+    class WorkerLogger(logging.LoggerAdapter):
+        def process(self, msg, kwargs):
+            return '[{0}] {1}'.format(self.extra['worker_id'], msg), kwargs
+
+    @property
+    def logger(self):
+        return self.WorkerLogger(logger, {'worker_id': self.id})
+
+    def start(self):
+        self.task = asyncio.ensure_future(self.supervisor.run(self.run))
+
+    async def run(self):
+        # Spawned, as forking would copy the coordinator's event loop and sockets
+        context = multiprocessing.get_context('spawn')
+        self.process = context.Process(target=self.target, args=(self.shard,), name='yahk-{0}'.format(self.shard))
+        self.process.start()
+        self.logger.info("Started worker (pid {0})".format(self.process.pid))
+        self.supervisor.up()
+
+        # The sentinel becomes readable when the process exits
+        loop = asyncio.get_event_loop()
+        exited = loop.create_future()
+        loop.add_reader(self.process.sentinel, lambda: exited.done() or exited.set_result(None))
+
+        try:
+            await exited
+        finally:
+            loop.remove_reader(self.process.sentinel)
+
+        self.process.join()
+        self.logger.warning("Worker exited with code {0}".format(self.process.exitcode))
+
+    def stop(self):
+        self.enabled = False
+
+        if self.task:
+            self.task.cancel()
+
+        if self.process and self.process.is_alive():
+            self.logger.debug("Stopping worker (pid {0})...".format(self.process.pid))
+            self.process.terminate()
+
+class RemoteSource(object):
+
+    """ Stands in for the service a message came from, on another shard """
+
+    def __init__(self, id, service_type):
+        self.id = id
+        self.service_type = service_type
+
+class ShardClient(object):
+
+    """ A shard worker's connection to the coordinator, re-established with backoff if it drops """
+
+    def __init__(self, bot, name, path):
+        self.bot = bot
+        self.name = name
+        self.path = path
+        self.id = 'shard/{0}'.format(name)
+        self.enabled = True
+
+        self.writer = None
+        self.task = None
+        self.announce_pending = False
+
+        # Reconnects to the coordinator, backing off while it's unreachable
+        self.supervisor = Supervisor(self, max_delay=30)
+
+        # Memberships the coordinator handed back, for chats we don't have
+        # yet (chat key -> bridge name), and the (bridge name, chat key)s
+        # with bridge members on other shards
+        self.assignments = {}
+        self.remote = frozenset()
+
+        self.renderers = {}
+        self.stats = collections.Counter()
+
+    class ShardLogger(logging.LoggerAdapter):
+        def process(self, msg, kwargs):
+            return '[{0}] {1}'.format(self.extra['shard_id'], msg), kwargs
+
+    @property
+    def logger(self):
+        return self.ShardLogger(logger, {'shard_id': self.id})
+
+    def start(self):
+        self.task = asyncio.ensure_future(self.supervisor.run(self.connect))
+
+    async def connect(self):
+        # Nobody left to reconnect to, or to restart us
+        parent = multiprocessing.parent_process()
+
+        if parent and not parent.is_alive():
+            self.logger.critical("Coordinator process has exited, shutting down")
+            self.enabled = False
+            asyncio.ensure_future(self.bot.quit())
+            return
+
+        reader, self.writer = await asyncio.open_unix_connection(self.path)
+        self.writer.write(encode(HELLO, [self.name]))
+        self.announce()
+        self.supervisor.up()
+
+        try:
+            await self._receive(reader)
+        finally:
+            # Routes are sent again once we're back
+            if self.writer:
+                self.writer.close()
+                self.writer = None
+            self.remote = frozenset()
+
+    def close(self):
+        self.enabled = False
+
+        if self.task:
+            self.task.cancel()
+
+        if self.writer:
+            self.writer.close()
+            self.writer = None
+
+    def schedule_announce(self):
+        # Membership tends to change in bursts - announce once it settles
+        if self.writer and not self.announce_pending:
+            self.announce_pending = True
+            asyncio.get_event_loop().call_soon(self.announce)
+
+    def announce(self):
+        self.announce_pending = False
+
+        if not self.writer:
+            return
+
+        self.apply_assignments()
+        members = {}
+
+        for bridge in list(self.bot.bridges.values()):
+            if bridge.named:
+                for chat in list(bridge.bridge_chats):
+                    members[chat_key(chat)] = bridge.name
+
+        # Still ours, even if the chat hasn't been created yet
+        for key, bridge_name in self.assignments.items():
+            members.setdefault(key, bridge_name)
+
+        self.writer.write(encode(MEMBERS, [[bridge_name, key[0], key[1]] for key, bridge_name in members.items()]))
+
+    def apply_assignments(self):
+        if not self.assignments:
+            return
+
+        for bridge in list(self.bot.bridges.values()):
+            for chat, bridge_chat in list(bridge.bridge_chats.items()):
+                bridge_name = self.assignments.pop(chat_key(chat), None)
+
+                if bridge_name is not None and bridge_chat.bridge.name != bridge_name:
+                    self.bot.rename_bridge(bridge_chat.bridge, bridge_name)
+
+    def has_routes(self, bridge, chat):
+        return (bridge.name, chat_key(chat)) in self.remote
+
+    def relay(self, bridge, relay):
+        if not self.writer:
+            return
+
+        if congested(self.writer):
+            self.stats['dropped'] += 1
+            self.logger.debug("Coordinator is not keeping up, dropped message for {0}".format(bridge.name))
+            return
+
+        chat = relay.chat_user.chat
+        self.writer.write(encode(RELAY, [
+            bridge.name, chat.service.id, chat.identifier, chat.service.service_type,
+            relay.chat_user.user.name, chat.name, relay.text, relay.base_hops, list(relay.origin)
+        ]))
+        self.stats['relayed'] += 1
+
+    async def _receive(self, reader):
+        try:
+            while True:
+                kind, fields = await read_frame(reader)
+
+                if kind == DELIVER:
+                    await self.deliver(*fields)
+                elif kind == ASSIGN:
+                    self.assignments.update({(service_id, identifier): bridge for bridge, service_id, identifier in fields})
+                    self.schedule_announce()
+                elif kind == ROUTES:
+                    self.remote = frozenset((bridge, (service_id, identifier)) for bridge, service_id, identifier in fields)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            # The supervisor logs the disconnect and reconnects
+            pass
+
+    async def deliver(self, bridge_name, service_id, service_type, user_name, chat_name, text, hops, origin, keys):
+        bridge = self.bot.bridges.get(bridge_name)
+
+        if not bridge:
+            return
+
+        if hops > self.bot.max_hops:
+            self.stats['too far'] += 1
+            return
+
+        # Never back to where it started, whichever way round it came
+        origin = tuple(origin)
+
+        source = RemoteSource(service_id, service_type)
+        chats = {(chat.service.id, chat.identifier): chat for chat in bridge.bridge_chats}
+        rendered = {}
+
+        for service_id, identifier in keys:
+            chat = chats.get((service_id, identifier))
+
+            if not chat or (service_id, identifier) == origin:
+                continue
+
+            service = chat.service
+            source_format = service.source_format or self.bot.source_format
+            key = render_key(service, source_format)
+
+            if key not in rendered:
+                pair = (service_type, service)
+                if pair not in self.renderers:
+                    self.renderers[pair] = compile_renderer(source, service)
+
+                rendered[key] = self.renderers[pair](source_format, user_name, chat_name, text)
+
+            await chat.send(rendered[key])
+            self.stats['delivered'] += 1
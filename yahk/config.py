@@ -13,7 +13,7 @@ class Config(object):
         try:
             with open('config.yml', 'r') as f:
                 c = f.read()
-                self.config = yaml.load(c)
+                self.config = yaml.safe_load(c)
                 logger.debug("Config loaded")
         except FileNotFoundError as e:
             logger.critical("Could not find configuration file!")
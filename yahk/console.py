@@ -1,7 +1,6 @@
 import logging
 import asyncio
 import argparse
-from aioconsole import AsynchronousConsole, AsynchronousCli
 
 logger = logging.getLogger(__name__)
 
@@ -69,19 +68,38 @@ class Console(object):
 
             for service_id in self.console.bot.services:
                 service = self.console.bot.services[service_id]
-                self.write_line(' - {0} ({1})'.format(
+                if service.ready_time is not None:
+                    state = 'ready in {0:.2f}s'.format(service.ready_time)
+                else:
+                    state = 'not ready'
+
+                stats = service.supervisor.stats()
+
+                self.write_line(' - {0} ({1}, {2}, {3}, {4} reconnects, {5:.1f}s down)'.format(
                     service_id,
-                    'enabled' if service.enabled else 'disabled'
+                    'enabled' if service.enabled else 'disabled',
+                    state,
+                    stats['state'],
+                    stats['reconnects'],
+                    stats['downtime']
                 ))
 
+                for name, value in service.stats().items():
+                    self.write_line('   - {0}: {1}'.format(name, value))
+
         def show_bridges(self):
             self.write_line('Current bridges:')
 
             for bridge_name in self.console.bot.bridges:
                 bridge = self.console.bot.bridges[bridge_name]
                 self.write_line(' - {0}'.format(bridge_name))
-                for chat in bridge.members:
+                for chat in bridge.bridge_chats:
                     self.write_line('   - {0} ({1})'.format(chat.name, chat.id))
+                for member in bridge.members:
+                    self.write_line('   - {0}'.format(member.name))
+
+            for bridge_name, (service_id, identifier) in self.console.bot.bridge_graph.check():
+                self.write_line(' ! cycle: {0}/{1} in {2}'.format(service_id, identifier, bridge_name))
 
         def show_connected_bridges(self):
             self.write_line('Current connected bridges:')
@@ -91,6 +109,86 @@ class Console(object):
                 for chat in bridge.members:
                     self.write_line('   - {0} ({1})'.format(chat.name, chat.id))
 
+        def show_dedupe(self):
+            stats = self.console.bot.recent.stats()
+
+            self.write_line('Duplicate suppression:')
+            self.write_line(' - {0}/{1} digests in a {2}s window'.format(
+                stats['size'], stats['capacity'], stats['window']
+            ))
+            self.write_line(' - {0} hits, {1} misses ({2:.1%} hit rate), {3} evicted'.format(
+                stats['hits'], stats['misses'], stats['hit_rate'], stats['evictions']
+            ))
+
+        def show_events(self):
+            events = self.console.bot.events
+            stats = events.stats()
+
+            self.write_line('Events ({0} subscribers, default policy {1}):'.format(
+                stats['subscribers'], events.default
+            ))
+
+            for event in sorted(events.policies):
+                self.write_line(' - {0}: {1}'.format(event, events.policies[event]))
+
+            for policy in sorted(stats['published']):
+                self.write_line(' - {0} {1}'.format(stats['published'][policy], policy))
+
+            for (service_id, event), count in sorted(stats['aggregates'].items()):
+                self.write_line('   - {0} {1}: {2}'.format(service_id, event, count))
+
+        def show_shards(self):
+            bot = self.console.bot
+            coordinator = bot.coordinator
+
+            if not coordinator:
+                self.write_line('Not sharded.')
+                return
+
+            self.write_line('Shards ({0} relayed, {1} delivered, {2} dropped):'.format(
+                coordinator.stats['relayed'], coordinator.stats['delivered'], coordinator.stats['dropped']
+            ))
+
+            for shard, worker in sorted(bot.workers.items()):
+                process = worker.process
+                self.write_line(' - {0} (pid {1}, {2}, {3}, {4} restarts): {5} bridged chats'.format(
+                    shard, process.pid if process else None,
+                    'alive' if process and process.is_alive() else 'exited',
+                    'connected' if shard in coordinator.shards else 'disconnected',
+                    worker.supervisor.reconnects, len(coordinator.members.get(shard, ()))
+                ))
+
+        def show_db(self):
+            writer = self.console.bot.db.writer
+
+            if not writer:
+                self.write_line('Database writes are synchronous.')
+                return
+
+            stats = writer.stats
+            self.write_line('Database writer (pid {0}):'.format(writer.process.pid if writer.process else None))
+            self.write_line(' - {0} written, {1} acknowledged, {2} failed, {3} pending'.format(
+                stats['written'], stats['acked'], stats['failed'], writer.pending
+            ))
+            self.write_line(' - {0} batches sent, {1} in flight, {2} buffered'.format(
+                stats['batches'], len(writer.inflight), len(writer.buffer)
+            ))
+
+        def show_plugins(self):
+            scheduler = self.console.bot.scheduler
+
+            self.write_line('Plugin handlers ({0} outstanding, backlog {1}):'.format(
+                len(scheduler.tasks), scheduler.backlog
+            ))
+
+            for name in sorted(scheduler.stats):
+                stats = scheduler.stats[name]
+                self.write_line(' - {0}: {1} calls, {2} running, {3} ok, {4} failed, {5} timed out, '
+                                '{6} cancelled, {7} rejected, {8:.3f}s mean, {9:.3f}s max'.format(
+                    name, stats.calls, stats.running, stats.completed, stats.failed, stats.timeouts,
+                    stats.cancelled, stats.rejected, stats.mean_time, stats.max_time
+                ))
+
         def join_bridge(self, bridge_name):
             if bridge_name not in self.console.bot.bridges:
                 self.write_line('Bridge name {0} not found.'.format(bridge_name))
@@ -117,8 +215,23 @@ class Console(object):
                 self.show_services()
             elif cmd[0] == "bridges":
                 self.show_bridges()
+            elif cmd[0] == "dedupe":
+                self.show_dedupe()
+            elif cmd[0] == "events":
+                self.show_events()
+            elif cmd[0] == "shards":
+                self.show_shards()
+            elif cmd[0] == "db":
+                self.show_db()
+            elif cmd[0] == "plugins":
+                self.show_plugins()
+            elif cmd[0] == "reload":
+                reloaded = self.console.bot.reload_plugins()
+                self.write_line('Reloaded plugins: {0}'.format(', '.join(reloaded) or 'none'))
             elif cmd[0] == "shutdown":
                 asyncio.ensure_future(self.console.bot.quit())
+            elif cmd[0] == "restart":
+                asyncio.ensure_future(self.console.bot.restart())
             elif cmd[0] == "join_bridge":
                 if len(cmd) < 2:
                     self.write_line('Missing argument to join_bridge')
@@ -4,6 +4,7 @@ from sqlalchemy import create_engine, Column, Integer, String, ForeignKey
 from sqlalchemy.orm import sessionmaker, relationship, Session
 from sqlalchemy.orm.exc import NoResultFound, MultipleResultsFound
 from yahk.db.classes import *
+from yahk.db.writer import DBWriter
 
 logger = logging.getLogger(__name__)
 logger.debug("Loading DB module...")
@@ -12,16 +13,22 @@ logger.debug("Loading DB module...")
 
 class DB(object):
 
-    def __init__(self):
+    def __init__(self, url='sqlite:///yahk.db'):
+        self.url = url
         self.engine = create_engine(
-            'sqlite:///yahk.db',
-            connect_args={'check_same_thread': False},
+            url,
+            # Same busy timeout as the writer process, which may be mid-commit
+            connect_args={'check_same_thread': False, 'timeout': 30},
             echo=False
         )
         self.sessionmaker = sessionmaker(bind=self.engine)
         self._destroy()
         Base.metadata.create_all(self.engine)
 
+        # Set by start_writer - chat, user, message, event and bridge chat
+        # rows are then written by a separate process, and never read back
+        self.writer = None
+
     def _destroy(self):
         Base.metadata.drop_all(self.engine)
 
@@ -29,6 +36,40 @@ class DB(object):
     def session(self) -> Session:
         return self.sessionmaker()
 
+    def start_writer(self, batch_size=500, linger=0.05):
+        self.writer = DBWriter(self.engine, self.url, batch_size=batch_size, linger=linger)
+        self.writer.start()
+
+    def store(self, obj, db_id=None):
+        """ Write obj, returning its row id """
+        if self.writer:
+            return self.writer.write(obj, db_id)
+
+        s = self.session
+        s.add(obj)
+        s.commit()
+        db_id = obj.id
+        s.close()
+
+        return db_id
+
+    def store_all(self, objs):
+        """ Write objs in a single transaction, returning their row ids """
+        if self.writer:
+            return [self.writer.write(obj, obj.id) for obj in objs]
+
+        s = self.session
+        s.add_all(objs)
+        s.commit()
+        db_ids = [obj.id for obj in objs]
+        s.close()
+
+        return db_ids
+
+    def close(self):
+        if self.writer:
+            self.writer.close()
+
     def get_bridge(self, db_id):
         s = self.session
 
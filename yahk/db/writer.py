@@ -0,0 +1,272 @@
+import asyncio
+import collections
+import logging
+import multiprocessing
+import pickle
+import queue
+import threading
+import time
+from sqlalchemy import create_engine, func, inspect
+from sqlalchemy.orm import sessionmaker
+
+logger = logging.getLogger(__name__)
+
+class DBWriter(object):
+
+    """ Ships row writes to a separate writer process
+
+    Each write is a compact record - (DB class, row id, new?, column values) -
+    taken from the ORM object the caller built.  Records are buffered and
+    sent over a pipe in batches; the writer process applies each batch in a
+    single transaction and acknowledges it.  Row ids are allocated here, so
+    callers never wait on the database.
+
+    Batches are pickled on the event loop but written to the pipe by a
+    feeder thread, so a full pipe (the writer busy in a commit) never blocks
+    the loop.  At most max_inflight_bytes of them are outstanding - anything
+    beyond that stays buffered until the writer catches up.
+    """
+
+    def __init__(self, engine, url, batch_size=500, linger=0.05, max_inflight_bytes=1024 * 1024):
+        self.engine = engine
+        self.url = url
+        self.batch_size = batch_size
+        self.linger = linger
+        self.max_inflight_bytes = max_inflight_bytes
+
+        self.conn = None
+        self.process = None
+        self.feeder = None
+        self.outgoing = queue.SimpleQueue()
+
+        self.buffer = []
+        self.flush_pending = False
+
+        # (records, bytes) for each batch sent but not yet acknowledged
+        self.inflight = collections.deque()
+        self.inflight_bytes = 0
+
+        # Next row id, per base table, and the column keys of each DB class
+        self.ids = {}
+        self.columns = {}
+
+        self.stats = collections.Counter()
+
+    def start(self):
+        # Forked, like the plugin process pool, so the writer never re-runs the
+        # launcher script (spawn would) - it only needs the DB classes, which
+        # are already loaded.  Done before the feeder thread exists.
+        context = multiprocessing.get_context('fork')
+        self.conn, child_conn = context.Pipe()
+
+        self.process = context.Process(
+            target=run_writer, args=(self.url, child_conn, self.batch_size, self.linger, self.conn), name='yahk-db'
+        )
+        self.process.start()
+        child_conn.close()
+
+        self.feeder = threading.Thread(target=self._feed, name='yahk-db-feeder', daemon=True)
+        self.feeder.start()
+
+        asyncio.get_event_loop().add_reader(self.conn.fileno(), self._receive_acks)
+        logger.info("Started database writer (pid {0})".format(self.process.pid))
+
+    def allocate(self, db_type):
+        table = inspect(db_type).base_mapper.local_table
+
+        if table not in self.ids:
+            # Carry on from whatever is already there
+            with self.engine.connect() as conn:
+                self.ids[table] = conn.execute(func.max(table.c.id).select()).scalar() or 0
+
+        self.ids[table] += 1
+        return self.ids[table]
+
+    def write(self, obj, db_id=None):
+        """ Queue obj to be written, returning its row id """
+        db_type = type(obj)
+
+        if db_type not in self.columns:
+            self.columns[db_type] = [attr.key for attr in inspect(db_type).column_attrs if attr.key != 'id']
+
+        new = db_id is None
+
+        if new:
+            db_id = self.allocate(db_type)
+
+        values = {key: obj.__dict__[key] for key in self.columns[db_type] if key in obj.__dict__}
+        self.buffer.append((db_type, db_id, new, values))
+        self.stats['written'] += 1
+
+        if not self.flush_pending:
+            self.flush_pending = True
+            asyncio.get_event_loop().call_soon(self.flush)
+
+        return db_id
+
+    def flush(self, everything=False):
+        self.flush_pending = False
+
+        while self.buffer and (everything or self.inflight_bytes < self.max_inflight_bytes):
+            batch = self.buffer[:self.batch_size]
+            del self.buffer[:self.batch_size]
+
+            data = pickle.dumps(batch, pickle.HIGHEST_PROTOCOL)
+            self.outgoing.put(data)
+
+            self.inflight.append((len(batch), len(data)))
+            self.inflight_bytes += len(data)
+            self.stats['batches'] += 1
+
+        if self.buffer:
+            self.stats['deferred'] += 1
+
+    def _feed(self):
+        # Runs in the feeder thread - the only place the pipe is written to
+        while True:
+            data = self.outgoing.get()
+
+            try:
+                self.conn.send_bytes(data)
+            except OSError as e:
+                logger.error("Could not send to database writer: {0}".format(e))
+                return
+
+            if data is stop:
+                return
+
+    def _receive_acks(self):
+        try:
+            while self.conn.poll():
+                self._ack(self.conn.recv())
+        except EOFError:
+            logger.critical("Database writer exited, {0} records unwritten".format(self.pending))
+            asyncio.get_event_loop().remove_reader(self.conn.fileno())
+            return
+
+        self.flush()
+
+    def _ack(self, ack):
+        count, failed = ack
+
+        _, size = self.inflight.popleft()
+        self.inflight_bytes -= size
+        self.stats['acked'] += count
+        self.stats['failed'] += failed
+
+    @property
+    def pending(self):
+        return self.stats['written'] - self.stats['acked'] - self.stats['failed']
+
+    def close(self):
+        """ Hand over everything still buffered, and wait for it to be written """
+        if not self.process:
+            return
+
+        asyncio.get_event_loop().remove_reader(self.conn.fileno())
+        self.flush(everything=True)
+        self.outgoing.put(stop)
+
+        logger.debug("Waiting for database writer ({0} records pending)...".format(self.pending))
+
+        # The writer hangs up once it has written everything
+        try:
+            while True:
+                self._ack(self.conn.recv())
+        except EOFError:
+            pass
+
+        self.feeder.join()
+        self.process.join()
+        self.process = None
+        self.conn.close()
+
+# Tells the writer process there's nothing more to come
+stop = pickle.dumps(None)
+
+def apply(session, record):
+    db_type, db_id, new, values = record
+    obj = db_type(**values)
+    obj.id = db_id
+
+    if new:
+        session.add(obj)
+    else:
+        # Only the columns that were set are updated
+        session.merge(obj)
+
+def run_writer(url, conn, batch_size, linger, parent_conn=None):
+    """ Entry point for the database writer process """
+    # Our copy of the bot's end - closed, so we see EOF if the bot goes away
+    if parent_conn:
+        parent_conn.close()
+
+    engine = create_engine(url, connect_args={'check_same_thread': False, 'timeout': 30})
+    Session = sessionmaker(bind=engine)
+
+    stopping = False
+
+    while not stopping:
+        batch = conn.recv()
+
+        if batch is None:
+            break
+
+        # Let a few more batches arrive, so each transaction covers more
+        # rows, without holding any up for longer than linger
+        sizes = [len(batch)]
+        deadline = time.monotonic() + linger
+
+        while len(batch) < batch_size and conn.poll(max(0, deadline - time.monotonic())):
+            more = conn.recv()
+
+            if more is None:
+                stopping = True
+                break
+
+            batch.extend(more)
+            sizes.append(len(more))
+
+        failed = write_batch(Session, batch)
+
+        # One ack per batch sent, as that's what the other end counts
+        ok = len(batch) - failed
+
+        for size in sizes:
+            done = min(size, ok)
+            conn.send((done, size - done))
+            ok -= done
+
+    conn.close()
+
+def write_batch(Session, batch):
+    """ Write records in one transaction, falling back to one at a time if it fails """
+    s = Session()
+
+    try:
+        for record in batch:
+            apply(s, record)
+        s.commit()
+        return 0
+    except Exception as e:
+        s.rollback()
+        logger.warning("Batch of {0} records failed ({1}), retrying individually".format(len(batch), e))
+    finally:
+        s.close()
+
+    failed = 0
+
+    for record in batch:
+        s = Session()
+
+        try:
+            apply(s, record)
+            s.commit()
+        except Exception as e:
+            s.rollback()
+            failed += 1
+            logger.error("Could not write {0} {1}: {2}".format(record[0].__name__, record[1], e))
+        finally:
+            s.close()
+
+    return failed
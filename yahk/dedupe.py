@@ -0,0 +1,115 @@
+import collections
+import hashlib
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+class Deduplicator(object):
+
+    """ Time-bucketed set of 64-bit message digests
+
+    The window is split into a number of buckets, each holding the digests seen
+    during its slice of time.  Whole buckets are dropped as they age out, so
+    expiry is O(1) per bucket rather than per entry, and only the 8-byte digest
+    of each message is kept in memory.
+    """
+
+    def __init__(self, window=1, capacity=100000, buckets=4):
+        self.window = window
+        self.capacity = capacity
+        self.span = window / buckets
+        self.buckets = collections.deque(maxlen=buckets + 1)
+
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        logger.debug("Deduplicator created with window {0}s, capacity {1}".format(
+            window, capacity
+        ))
+
+    @staticmethod
+    def digest(*parts):
+        key = '\x00'.join(str(part) for part in parts).encode('utf-8', 'surrogatepass')
+        return int.from_bytes(hashlib.blake2b(key, digest_size=8).digest(), 'little')
+
+    def _rotate(self, now):
+        generation = int(now / self.span)
+        oldest = generation - self.buckets.maxlen + 1
+
+        while self.buckets and self.buckets[0][0] < oldest:
+            _, expired = self.buckets.popleft()
+            self.size -= len(expired)
+
+        if not self.buckets or self.buckets[-1][0] != generation:
+            if len(self.buckets) == self.buckets.maxlen:
+                _, expired = self.buckets.popleft()
+                self.size -= len(expired)
+            self.buckets.append((generation, set()))
+
+        return self.buckets[-1][1]
+
+    def _evict(self):
+        # Over capacity - drop the oldest bucket early rather than growing
+        while self.size >= self.capacity and len(self.buckets) > 1:
+            _, evicted = self.buckets.popleft()
+            self.size -= len(evicted)
+            self.evictions += len(evicted)
+
+        if self.size >= self.capacity:
+            # A single bucket holds everything, so start it afresh
+            current = self.buckets[-1][1]
+            self.evictions += len(current)
+            self.size -= len(current)
+            current.clear()
+
+    def seen_digest(self, digest, now=None):
+        """ Return True if digest was seen within the window, recording it if not """
+        current = self._rotate(time.monotonic() if now is None else now)
+
+        for _, bucket in self.buckets:
+            if digest in bucket:
+                self.hits += 1
+                return True
+
+        self.misses += 1
+
+        if self.size >= self.capacity:
+            self._evict()
+
+        current.add(digest)
+        self.size += 1
+        return False
+
+    def seen(self, *parts):
+        return self.seen_digest(self.digest(*parts))
+
+    def __contains__(self, digest):
+        self._rotate(time.monotonic())
+        return any(digest in bucket for _, bucket in self.buckets)
+
+    def __len__(self):
+        return self.size
+
+    @property
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def stats(self):
+        return {
+            'size': self.size,
+            'capacity': self.capacity,
+            'window': self.window,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'hit_rate': self.hit_rate
+        }
+
+    def __repr__(self):
+        return "<{0}: {1}/{2} in {3}s, {4:.1%} hits>".format(
+            self.__class__.__name__, self.size, self.capacity, self.window, self.hit_rate
+        )
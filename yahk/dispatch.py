@@ -0,0 +1,128 @@
+import logging
+import re
+
+logger = logging.getLogger(__name__)
+
+# Patterns that can't safely be merged into one alternation - references to
+# groups (backreferences, conditionals) would be renumbered, and global
+# inline flags are only valid at the start.  Any pattern with groups of its
+# own is kept standalone too.
+standalone_re = re.compile(r'\\[1-9]|\(\?P=|\(\?\(|^\(\?[aiLmsux]+\)')
+
+class Dispatcher(object):
+
+    """ Compiled lookup of plugin commands and regex matches
+
+    Commands are a dict hit (after alias resolution).  Match patterns are
+    compiled once and merged into a single alternation which acts as a
+    prefilter - a message that matches none of them is rejected in one pass,
+    and when it does match, only patterns after the first matching alternative
+    need to be tried individually.
+    """
+
+    def __init__(self, bot):
+        self.bot = bot
+        self.aliases = {}
+
+        self.commands = {}
+        self.combined = None
+        self.patterns = ()
+        self.standalone = ()
+
+    def add_alias(self, alias, command):
+        logger.debug("Aliasing command {0} to {1}".format(alias, command))
+        self.aliases[alias] = command
+        self.compile()
+
+    def compile(self):
+        commands = dict(self.bot.commands)
+
+        for alias, command in self.aliases.items():
+            if command in commands:
+                commands[alias] = commands[command]
+            else:
+                logger.warning("Alias {0} refers to unknown command {1}".format(alias, command))
+
+        patterns = []
+        standalone = []
+
+        for match, handler in self.bot.matches.items():
+            try:
+                compiled = re.compile(match)
+            except re.error as e:
+                logger.error("Could not compile match {0}: {1}".format(match, e))
+                continue
+
+            if compiled.groups or standalone_re.search(match):
+                standalone.append((match, compiled, handler))
+            else:
+                patterns.append((match, compiled, handler))
+
+        combined = None
+
+        if patterns:
+            try:
+                combined = re.compile('|'.join(
+                    '(?P<_m{0}>{1})'.format(i, match) for i, (match, _, _) in enumerate(patterns)
+                ))
+            except re.error as e:
+                # Something we didn't anticipate doesn't merge - try them all one by one
+                logger.warning("Could not combine match patterns, matching individually: {0}".format(e))
+                standalone = patterns + standalone
+                patterns = []
+
+        # Swap everything in at once so in-flight lookups see a consistent view
+        self.commands, self.combined, self.patterns, self.standalone = (
+            commands, combined, tuple(patterns), tuple(standalone)
+        )
+
+        logger.debug("Compiled {0} commands, {1} combined and {2} standalone matches".format(
+            len(commands), len(patterns), len(standalone)
+        ))
+
+    def command(self, message):
+        """ Return (command, handler, args) for a prefixed message, or None """
+        prefix = self.bot.prefix
+
+        if not message.startswith(prefix):
+            return None
+
+        text = message[len(prefix):]
+
+        if not text or text[0].isspace():
+            return None
+
+        args = text.split()
+        command = args.pop(0)
+        handler = self.commands.get(command)
+
+        if not handler:
+            return None
+
+        return command, handler, args
+
+    def matching(self, message):
+        """ Yield (pattern, handler) for every match pattern that matches message """
+        combined, patterns, standalone = self.combined, self.patterns, self.standalone
+
+        if combined:
+            m = combined.match(message)
+
+            if m:
+                first = int(m.lastgroup[2:])
+                yield patterns[first][0], patterns[first][2]
+
+                for match, compiled, handler in patterns[first + 1:]:
+                    if compiled.match(message):
+                        yield match, handler
+
+        for match, compiled, handler in standalone:
+            if compiled.match(message):
+                yield match, handler
+
+    def wants(self, message):
+        """ Whether any command or match would handle message """
+        if message.startswith(self.bot.prefix):
+            return self.command(message) is not None
+
+        return next(self.matching(message), None) is not None
@@ -0,0 +1,89 @@
+import asyncio
+import collections
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Persistence policies
+PERSIST = 'persist'
+AGGREGATE = 'aggregate'
+EPHEMERAL = 'ephemeral'
+
+policies = (PERSIST, AGGREGATE, EPHEMERAL)
+
+# Events with no lasting value, unless the config says otherwise
+default_policies = {
+    'user_typing': EPHEMERAL
+}
+
+class EventBus(object):
+
+    """ Decides what happens to service events, and fans them out in memory
+
+    Every event has a policy, looked up by event name (user_joined,
+    topic_set, user_typing...):
+
+     - persist: saved as an Event row, as before
+     - aggregate: only counted, per service and event name
+     - ephemeral: nothing kept at all
+
+    Whatever the policy, subscribers are called with the event object, so
+    plugins can react to things that are never written to the database.
+    """
+
+    def __init__(self, default=PERSIST, policies=None):
+        self.default = self._check(default)
+        self.policies = dict(default_policies)
+
+        for event, policy in (policies or {}).items():
+            self.policies[event] = self._check(policy)
+
+        self.subscribers = []
+
+        self.published = collections.Counter()
+        self.aggregates = collections.Counter()
+
+    @staticmethod
+    def _check(policy):
+        if policy not in policies:
+            raise ValueError("Unknown event policy {0} (expected one of {1})".format(policy, ', '.join(policies)))
+        return policy
+
+    def policy(self, event):
+        return self.policies.get(event, self.default)
+
+    def subscribe(self, callback, events=None):
+        """ Call callback(event) for every event, or only those named in events
+
+        Coroutine functions are scheduled rather than awaited, so a slow
+        subscriber never holds up the service that raised the event.
+        """
+        self.subscribers.append((callback, set(events) if events else None))
+
+    def unsubscribe(self, callback):
+        self.subscribers = [s for s in self.subscribers if s[0] != callback]
+
+    def publish(self, event):
+        self.published[event.policy] += 1
+
+        if event.policy == AGGREGATE:
+            self.aggregates[(event.service.id, event.event)] += 1
+
+        for callback, events in self.subscribers:
+            if events is not None and event.event not in events:
+                continue
+
+            try:
+                result = callback(event)
+
+                if asyncio.iscoroutine(result):
+                    asyncio.ensure_future(result)
+            except Exception as e:
+                logger.exception("Event subscriber {0} failed: {1}".format(callback, e))
+
+    def stats(self):
+        return {
+            'published': dict(self.published),
+            'aggregates': dict(self.aggregates),
+            'subscribers': len(self.subscribers)
+        }
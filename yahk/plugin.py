@@ -2,6 +2,16 @@
 # This borrows heavily from how Sopel uses decorators for plugins, with some minor changes
 # See https://github.com/sopel-irc/sopel/blob/master/sopel/module.py
 
+import asyncio
+import collections
+import functools
+import importlib
+
+# Picklable stand-ins for the live bridge_chat/chat_user objects, passed to
+# handlers that run in the process pool
+ChatSnapshot = collections.namedtuple('ChatSnapshot', ['id', 'identifier', 'name', 'service', 'bridge'])
+UserSnapshot = collections.namedtuple('UserSnapshot', ['id', 'identifier', 'name', 'service'])
+
 def commands(*commands):
 
     def add_commands(function):
@@ -22,8 +32,57 @@ def matches(value):
 
     return add_matches
 
+def _run_cpu_bound(module_name, qualname, args, chat, user, message):
+    # Runs in a pool worker - resolve the plugin function by name rather than
+    # pickling it, since the class attribute is the async wrapper
+    obj = importlib.import_module(module_name)
+
+    for name in qualname.split('.'):
+        obj = getattr(obj, name)
+
+    return obj.__wrapped__(args, chat, user, message)
+
+def cpu_bound(function):
+    """ Run a plugin handler in the bot's process pool
+
+    The decorated function is synchronous and takes no `self` - it receives
+    (args, chat, user, message) with ChatSnapshot/UserSnapshot in place of the
+    live objects, and whatever it returns (if not None) is sent to the chat.
+    """
+
+    @functools.wraps(function)
+    async def run_in_pool(self, args, bridge_chat, chat_user, message):
+        chat = ChatSnapshot(
+            bridge_chat.chat.id,
+            bridge_chat.chat.identifier,
+            bridge_chat.chat.name,
+            bridge_chat.chat.service.name,
+            bridge_chat.bridge.name
+        )
+        user = UserSnapshot(
+            chat_user.user.id,
+            chat_user.user.identifier,
+            chat_user.user.name,
+            chat_user.user.service.name
+        )
+
+        result = await asyncio.get_event_loop().run_in_executor(
+            self.bot.process_pool, _run_cpu_bound,
+            function.__module__, function.__qualname__, args, chat, user, message
+        )
+
+        if result is not None:
+            await bridge_chat.send(result)
+
+    run_in_pool.cpu_bound = True
+    return run_in_pool
+
 class Plugin(object):
 
+    # Per-plugin overrides for the scheduler defaults (None means use the default)
+    timeout = None
+    concurrency = None
+
     def __init__(self, bot):
         self.bot = bot
 
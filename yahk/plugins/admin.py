@@ -31,6 +31,11 @@ class AdminPlugin(Plugin):
         else:
             await chat.send("No name given!")
 
+    @commands('reload')
+    async def reload(self, args, bridge_chat, chat_user, message):
+        reloaded = self.bot.reload_plugins()
+        await bridge_chat.send("Reloaded plugins: {0}".format(', '.join(reloaded) or 'none'))
+
     @commands('whoami')
     async def whoami(self, args, bridge_chat, chat_user, message):
         await bridge_chat.send("You are {0} ({1}), in {2} ({3}) on {4}".format(
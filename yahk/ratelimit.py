@@ -0,0 +1,150 @@
+import asyncio
+import itertools
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+class TokenBucket(object):
+
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.paused_until = 0
+
+    def delay(self, now):
+        """ Seconds until a token is available """
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+        if now < self.paused_until:
+            return self.paused_until - now
+
+        if self.tokens >= 1:
+            return 0
+
+        return (1 - self.tokens) / self.rate
+
+    def take(self):
+        self.tokens -= 1
+
+    def pause(self, seconds):
+        # Server told us to back off - nothing goes through until then, and
+        # we start again from an empty bucket rather than a burst
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+        self.tokens = 0
+
+    def __repr__(self):
+        return "<{0}: {1:.2f}/s, {2:.1f} tokens>".format(self.__class__.__name__, self.rate, self.tokens)
+
+class RateLimiter(object):
+
+    """ Priority-ordered access to a set of token buckets
+
+    Callers acquire() a slot for a bucket key with a priority (lower goes
+    first).  A slot is granted when the key's bucket has a token and fewer
+    than `concurrency` requests are in flight; among eligible waiters, the
+    highest priority wins, so urgent work overtakes queued bulk work once a
+    pause or a full pipeline clears.
+    """
+
+    def __init__(self, concurrency=10):
+        self.concurrency = concurrency
+        self.buckets = {}
+        self.waiting = []
+        self.active = 0
+
+        self.granted = 0
+        self.throttled = 0
+
+        self._seq = itertools.count()
+        self._changed = asyncio.Event()
+        self._pump = None
+
+    def bucket(self, key, rate, burst=1):
+        if key not in self.buckets:
+            self.buckets[key] = TokenBucket(rate, burst)
+        return self.buckets[key]
+
+    def pause(self, key, seconds):
+        if key in self.buckets:
+            logger.warning("Pausing {0} for {1}s".format(key, seconds))
+            self.buckets[key].pause(seconds)
+            self.throttled += 1
+
+    async def acquire(self, key, priority=0):
+        bucket = self.buckets[key]
+
+        # Fast path - nothing queued and capacity available
+        if not self.waiting and self.active < self.concurrency and bucket.delay(time.monotonic()) == 0:
+            bucket.take()
+            self.active += 1
+            self.granted += 1
+            return
+
+        future = asyncio.get_event_loop().create_future()
+        self.waiting.append((priority, next(self._seq), key, future))
+        self._kick()
+
+        try:
+            await future
+        except asyncio.CancelledError:
+            # Granted just as we were cancelled - hand the slot back
+            if future.done() and not future.cancelled():
+                self.release()
+            raise
+
+    def release(self):
+        self.active -= 1
+        self._kick()
+
+    def _kick(self):
+        self._changed.set()
+
+        if not self._pump or self._pump.done():
+            self._pump = asyncio.ensure_future(self._run())
+
+    async def _run(self):
+        while self.waiting:
+            self._changed.clear()
+            now = time.monotonic()
+            wait = None
+
+            self.waiting = [w for w in self.waiting if not w[3].done()]
+            self.waiting.sort()
+
+            for waiter in list(self.waiting):
+                if self.active >= self.concurrency:
+                    break
+
+                priority, _, key, future = waiter
+                delay = self.buckets[key].delay(now)
+
+                if delay == 0:
+                    self.buckets[key].take()
+                    self.waiting.remove(waiter)
+                    self.active += 1
+                    self.granted += 1
+                    future.set_result(None)
+                else:
+                    wait = delay if wait is None else min(wait, delay)
+
+            if not self.waiting:
+                break
+
+            # Sleep until a bucket refills, or something changes (a release,
+            # a new waiter) - whichever comes first
+            try:
+                await asyncio.wait_for(self._changed.wait(), wait)
+            except asyncio.TimeoutError:
+                pass
+
+    def stats(self):
+        return {
+            'active': self.active,
+            'waiting': len(self.waiting),
+            'granted': self.granted,
+            'throttled': self.throttled
+        }
@@ -0,0 +1,209 @@
+import asyncio
+import collections
+import logging
+
+from yahk.render import compile_renderer, render_key
+
+logger = logging.getLogger(__name__)
+
+# A precomputed destination for relayed messages, with its formatting resolved
+Route = collections.namedtuple('Route', ['bridge_chat', 'send', 'hops', 'source_format', 'render', 'render_key'])
+
+def chat_key(chat):
+    """ Stable key for a chat, independent of its (changeable) name """
+    return chat.service.id, chat.identifier
+
+class Relay(object):
+
+    """ A message on its way through one or more bridges
+
+    Carries where the message came from, how many bridges it has crossed and
+    every chat it has already been delivered to.  A chat is never delivered
+    the same message twice, and it stops after max_hops bridge crossings, so
+    even a cyclic bridge layout can't make it bounce around.  A message that
+    arrives from another shard starts out with the hops it made there.
+    """
+
+    __slots__ = ('text', 'source', 'chat_user', 'origin', 'base_hops', 'hops', 'max_hops', 'visited')
+
+    def __init__(self, text, source, chat_user, max_hops=3, hops=0, origin=None):
+        self.text = text
+        self.source = source
+        self.chat_user = chat_user
+        self.origin = origin or chat_key(source.chat)
+        self.base_hops = hops
+        self.hops = hops
+        self.max_hops = max_hops
+
+        # The origin counts as visited, so nothing is relayed back to it
+        self.visited = {self.origin, chat_key(source.chat)}
+
+    def reaches(self, hops):
+        """ Whether a route hops bridges further on is still within max_hops """
+        return self.base_hops + hops <= self.max_hops
+
+    def visit(self, chat):
+        """ Record delivery to chat, returning False if it already had this message """
+        key = chat_key(chat)
+
+        if key in self.visited:
+            return False
+
+        self.visited.add(key)
+        return True
+
+    def __repr__(self):
+        return "<{0}: from {1}/{2}, {3} hops, {4} visited>".format(
+            self.__class__.__name__, self.origin[0], self.origin[1], self.hops, len(self.visited)
+        )
+
+class BridgeGraph(object):
+
+    """ Which chats are in which bridges, and where each message goes
+
+    Bridges and chats are the two sides of a bipartite graph.  From it we
+    compile a routing table - for every BridgeChat, the tuple of Routes a
+    message received there is sent out on, found breadth-first through the
+    bridges its chat and their chats belong to (up to max_hops), each chat
+    once, with the renderer for its pair of services.  Relaying is then one
+    dict lookup.
+
+    Everything is rebuilt once membership changes settle (so creating a
+    few thousand chats doesn't rebuild it a few thousand times), or on first
+    use if that's sooner, and swapped in at once.  Adding a membership that
+    connects two already connected nodes closes a cycle, which would
+    otherwise give a message more than one path to the same chat - those
+    are logged as soon as the graph is rebuilt.
+    """
+
+    def __init__(self, bot):
+        self.bot = bot
+        self.dirty = True
+        self.build_pending = False
+
+        self._bridges_of = {}
+        self._routes = {}
+        self.cycles = []
+
+    def invalidate(self):
+        self.dirty = True
+
+        # Rebuild (and look for cycles) when the current burst of changes is
+        # done, rather than waiting for the next message to need it
+        if not self.build_pending:
+            self.build_pending = True
+            asyncio.get_event_loop().call_soon(self._scheduled_build)
+
+    def _scheduled_build(self):
+        self.build_pending = False
+
+        if self.dirty:
+            self.build()
+
+    @property
+    def bridges_of(self):
+        if self.dirty:
+            self.build()
+        return self._bridges_of
+
+    @property
+    def routes(self):
+        if self.dirty:
+            self.build()
+        return self._routes
+
+    def check(self):
+        """ Return the membership edges that close a cycle """
+        if self.dirty:
+            self.build()
+        return self.cycles
+
+    def build(self):
+        self.dirty = False
+        bridges = list(self.bot.bridges.values())
+        bridges_of = {}
+        cycles = []
+        parent = {}
+
+        def find(node):
+            parent.setdefault(node, node)
+
+            while parent[node] != node:
+                parent[node] = parent[parent[node]]
+                node = parent[node]
+
+            return node
+
+        for bridge in bridges:
+            for chat in list(bridge.bridge_chats):
+                key = chat_key(chat)
+                bridges_of.setdefault(key, []).append(bridge)
+
+                a, b = find(('bridge', bridge.name)), find(('chat', key))
+
+                if a == b:
+                    cycles.append((bridge.name, key))
+                else:
+                    parent[a] = b
+
+        routes = {}
+        renderers = {}
+
+        for bridge in bridges:
+            for bridge_chat in list(bridge.bridge_chats.values()):
+                routes[bridge_chat] = self._compile(bridge, bridge_chat, bridges_of, renderers)
+
+        self._bridges_of, self._routes, self.cycles = bridges_of, routes, cycles
+
+        for bridge_name, (service_id, identifier) in cycles:
+            logger.warning("Bridge cycle: {0}/{1} in bridge {2} is already connected to it through other bridges".format(
+                service_id, identifier, bridge_name
+            ))
+
+        logger.debug("Compiled {0} routes across {1} bridges".format(
+            sum(len(r) for r in routes.values()), len(bridges)
+        ))
+
+        return cycles
+
+    def _compile(self, bridge, source, bridges_of, renderers):
+        """ Routes for messages received on source, nearest bridges first """
+        max_hops = self.bot.max_hops
+        default_format = getattr(self.bot, 'source_format', 'long')
+
+        routes = []
+        seen_chats = {chat_key(source.chat)}
+        seen_bridges = {bridge}
+        frontier = collections.deque([(bridge, 0)])
+
+        while frontier:
+            bridge, hops = frontier.popleft()
+            chats = list(bridge.bridge_chats.items())
+
+            for chat, bridge_chat in chats:
+                key = chat_key(chat)
+
+                if key not in seen_chats:
+                    seen_chats.add(key)
+                    source_format = chat.service.source_format or default_format
+
+                    # Renderers are shared by every route between the same two services
+                    pair = (source.chat.service, chat.service)
+                    if pair not in renderers:
+                        renderers[pair] = compile_renderer(*pair)
+
+                    routes.append(Route(
+                        bridge_chat, chat.send, hops, source_format,
+                        renderers[pair], render_key(chat.service, source_format)
+                    ))
+
+            if hops >= max_hops:
+                continue
+
+            for chat, _ in chats:
+                for other in bridges_of.get(chat_key(chat), ()):
+                    if other not in seen_bridges:
+                        seen_bridges.add(other)
+                        frontier.append((other, hops + 1))
+
+        return tuple(routes)
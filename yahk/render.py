@@ -0,0 +1,92 @@
+import logging
+import re
+
+logger = logging.getLogger(__name__)
+
+# mIRC colour codes, with their optional foreground/background numbers, and
+# the hex colour variant
+irc_colour_re = re.compile(r'\x03(?:\d{1,2}(?:,\d{1,2})?)?|\x04(?:[0-9a-fA-F]{6}(?:,[0-9a-fA-F]{6})?)?')
+
+# The rest of the IRC formatting codes - bold, reset, monospace, reverse,
+# italic, strikethrough and underline
+irc_formatting = str.maketrans('', '', '\x02\x0f\x11\x16\x1d\x1e\x1f')
+
+# Control characters that mustn't reach an IRC server - everything below
+# 0x20 apart from newlines (IRCChat.send splits on those) and formatting codes
+irc_unsafe = str.maketrans({
+    c: None for c in range(32) if chr(c) not in '\n\x02\x03\x04\x0f\x11\x16\x1d\x1e\x1f'
+})
+
+# Control characters other than newlines and tabs, for services that show text as-is
+control_chars = str.maketrans({c: None for c in range(32) if chr(c) not in '\n\t'})
+
+def strip_irc_formatting(text):
+    return irc_colour_re.sub('', text).translate(irc_formatting)
+
+def irc_safe(text):
+    return text.translate(irc_unsafe)
+
+def strip_control(text):
+    return text.translate(control_chars)
+
+def format_sender(source_format, user_name, chat_name):
+    """ The tag a relayed message starts with """
+    if source_format == 'short':
+        return "<{0}> ".format(user_name)
+
+    return "<{0}@{1}> ".format(user_name, chat_name)
+
+# Steps for each (source service type, destination service type); after
+# them, the destination's translate_out turns the plain text into its own
+# markup (escaping and mentions, for Slack)
+pipelines = {
+    ('irc', 'irc'): (irc_safe,),
+    ('irc', 'slack'): (strip_irc_formatting, strip_control),
+    ('slack', 'irc'): (irc_safe,),
+    ('slack', 'slack'): ()
+}
+
+# For pairs not listed above, by destination type
+default_pipelines = {
+    'irc': (irc_safe,),
+    'slack': (strip_control,)
+}
+
+def pipeline(source_type, destination_type):
+    steps = pipelines.get((source_type, destination_type))
+    return steps if steps is not None else default_pipelines.get(destination_type, ())
+
+def compile_renderer(source, destination):
+    """ Return a function rendering relayed messages from service source for service destination
+
+    The message body is translated into the destination's markup on its own
+    (so rules anchored at its start, like Slack's "nick:" mentions, apply),
+    and the sender tag is only escaped - a nick or channel name in it must
+    never become a mention.
+    """
+    steps = pipeline(source.service_type, destination.service_type)
+    translate = destination.translate_out
+    escape = destination.escape_out
+
+    def clean(text):
+        for step in steps:
+            text = step(text)
+        return text
+
+    def render(source_format, user_name, chat_name, text):
+        return escape(clean(format_sender(source_format, user_name, chat_name))) + translate(clean(text), source)
+
+    return render
+
+def render_key(destination, source_format):
+    """ Key under which a rendering is shared between destinations
+
+    Destinations of the same type and format share one rendering, unless the
+    service renders per instance (e.g. mentions resolved against its own
+    directory).
+    """
+    return (
+        destination.service_type,
+        source_format,
+        destination if destination.render_per_service else None
+    )
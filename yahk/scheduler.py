@@ -0,0 +1,144 @@
+import asyncio
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+class HandlerStats(object):
+
+    def __init__(self, name):
+        self.name = name
+        self.calls = 0
+        self.running = 0
+        self.completed = 0
+        self.failed = 0
+        self.timeouts = 0
+        self.cancelled = 0
+        self.rejected = 0
+        self.total_time = 0.0
+        self.max_time = 0.0
+
+    def record(self, elapsed):
+        self.total_time += elapsed
+        self.max_time = max(self.max_time, elapsed)
+
+    @property
+    def mean_time(self):
+        finished = self.completed + self.failed + self.timeouts + self.cancelled
+        return self.total_time / finished if finished else 0.0
+
+    def __repr__(self):
+        return "<{0}: {1}>".format(self.__class__.__name__, self.name)
+
+class Scheduler(object):
+
+    """ Runs plugin handlers as supervised tasks
+
+    Handlers are started in their own task so the receive path never waits on
+    plugin work.  Each plugin gets a concurrency cap (a semaphore shared by all
+    of its handlers) and each call a timeout; the number of outstanding calls
+    across all plugins is bounded by the backlog.  Plugin classes may override
+    the defaults by setting `timeout` and `concurrency` attributes.
+    """
+
+    def __init__(self, timeout=30, concurrency=4, backlog=256):
+        self.timeout = timeout
+        self.concurrency = concurrency
+        self.backlog = backlog
+
+        self.tasks = {}
+        self.semaphores = {}
+        self.stats = {}
+
+    @staticmethod
+    def plugin_name(handler):
+        plugin = getattr(handler, '__self__', None)
+        return plugin.__class__.__name__ if plugin is not None else handler.__module__
+
+    @classmethod
+    def handler_name(cls, handler):
+        return "{0}.{1}".format(cls.plugin_name(handler), handler.__name__)
+
+    def _setting(self, handler, name):
+        value = getattr(getattr(handler, '__self__', None), name, None)
+        return value if value is not None else getattr(self, name)
+
+    def _semaphore(self, handler):
+        plugin_name = self.plugin_name(handler)
+
+        if plugin_name not in self.semaphores:
+            self.semaphores[plugin_name] = asyncio.Semaphore(self._setting(handler, 'concurrency'))
+
+        return self.semaphores[plugin_name]
+
+    def _stats(self, handler):
+        name = self.handler_name(handler)
+
+        if name not in self.stats:
+            self.stats[name] = HandlerStats(name)
+
+        return self.stats[name]
+
+    def submit(self, handler, *args):
+        """ Schedule handler(*args) and return its task, or None if the backlog is full """
+        stats = self._stats(handler)
+        stats.calls += 1
+
+        if len(self.tasks) >= self.backlog:
+            stats.rejected += 1
+            logger.warning("Plugin backlog full ({0}), dropping call to {1}".format(
+                self.backlog, stats.name
+            ))
+            return None
+
+        task = asyncio.ensure_future(self._run(handler, args, stats))
+        self.tasks[task] = self.plugin_name(handler)
+        task.add_done_callback(self._done)
+
+        return task
+
+    def _done(self, task):
+        self.tasks.pop(task, None)
+
+    async def _run(self, handler, args, stats):
+        timeout = self._setting(handler, 'timeout')
+
+        async with self._semaphore(handler):
+            stats.running += 1
+            start = time.monotonic()
+
+            try:
+                await asyncio.wait_for(handler(*args), timeout)
+            except asyncio.TimeoutError:
+                stats.timeouts += 1
+                logger.warning("{0} timed out after {1}s".format(stats.name, timeout))
+            except asyncio.CancelledError:
+                stats.cancelled += 1
+                logger.debug("{0} cancelled".format(stats.name))
+                raise
+            except Exception as e:
+                stats.failed += 1
+                logger.exception("{0} failed: {1}".format(stats.name, e))
+            else:
+                stats.completed += 1
+            finally:
+                stats.running -= 1
+                stats.record(time.monotonic() - start)
+
+    def cancel(self, plugin_name=None):
+        """ Cancel outstanding calls, either for one plugin or for all of them """
+        cancelled = []
+
+        for task, name in list(self.tasks.items()):
+            if plugin_name is None or name == plugin_name:
+                task.cancel()
+                cancelled.append(task)
+
+        logger.debug("Cancelled {0} plugin calls".format(len(cancelled)))
+        return cancelled
+
+    async def shutdown(self):
+        tasks = self.cancel()
+
+        if tasks:
+            await asyncio.gather(*tasks, return_exceptions=True)
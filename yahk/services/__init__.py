@@ -1,7 +1,12 @@
+import asyncio
 import logging
+import time
 import yahk.db
 import uuid
-import re
+from yahk.supervisor import Supervisor
+from yahk.dedupe import Deduplicator
+from yahk.relay import Relay
+from yahk.events import PERSIST
 from yahk.db.classes import DBService, DBChat, DBUser, DBMessage, DBBridge, DBBridgeChat, DBBotUser
 #from yahk import bot
 from datetime import datetime
@@ -19,6 +24,14 @@ class Service(object):
     event_class = None
     bridge_chat_class = None
 
+    # Used to pick how relayed text is rendered for us (see yahk.render)
+    service_type = None
+    render_per_service = False
+
+    # How relayed senders are shown here - 'short' or 'long', or None for
+    # the bot's source_format
+    source_format = None
+
     def __init__(self, bot, id, name, enabled=True, me=None):
         self.bot = bot
         self.db = bot.db
@@ -33,7 +46,69 @@ class Service(object):
         self.chats = {}
         self.users = []
 
-        self.save()
+        # Bring-up timing - see mark_starting() and mark_ready()
+        self.start_time = None
+        self.ready_time = None
+        self.ready_event = asyncio.Event()
+
+        # Reconnect pacing and health
+        main = bot.config.config['main']
+        self.supervisor = Supervisor(
+            self,
+            base_delay=main['reconnect_delay'] if 'reconnect_delay' in main else 1,
+            max_delay=main['reconnect_max_delay'] if 'reconnect_max_delay' in main else 300
+        )
+
+        # What we've sent recently, so it can be recognised if it comes back
+        self.recent_sends = Deduplicator(
+            window=main['echo_window'] if 'echo_window' in main else 10,
+            capacity=main['echo_capacity'] if 'echo_capacity' in main else 10000
+        )
+        self.echoes = 0
+
+        # Not saved yet - Bot.setup() writes every service's row in one go,
+        # rather than each constructor committing its own
+
+    def mark_starting(self):
+        self.start_time = time.monotonic()
+        self.ready_time = None
+        self.ready_event.clear()
+
+    def mark_ready(self):
+        """ Called by the service once it's connected and has joined its chats """
+        if self.ready_time is None and self.start_time is not None:
+            self.ready_time = time.monotonic() - self.start_time
+            self.logger.info("Ready after {0:.2f}s".format(self.ready_time))
+
+        self.supervisor.up()
+        self.ready_event.set()
+
+    def stats(self):
+        """ Service-specific statistics, shown by the console """
+        return {
+            'echoes dropped': self.echoes
+        }
+
+    def remember_sent(self, chat_identifier, text):
+        self.recent_sends.seen(chat_identifier, text)
+
+    def sent_recently(self, chat_identifier, text):
+        return self.recent_sends.digest(chat_identifier, text) in self.recent_sends
+
+    def translate_in(self, text):
+        """ Convert received text from the service's markup to plain text """
+        return text
+
+    def translate_out(self, text, source=None):
+        """ Convert plain text relayed from source into the service's markup """
+        return text
+
+    def escape_out(self, text):
+        """ Make plain text safe to send as-is, without adding any markup """
+        return text
+
+    async def quit(self):
+        self.enabled = False
 
     @property
     def me(self):
@@ -44,9 +119,12 @@ class Service(object):
         self._me = value
         self.save()
 
-    def save(self):
-        # Get or create DB object
-        if self.db_id:
+    def db_object(self, lookup=True):
+        """ Our DB object, with the current details filled in - lookup=False always makes a new one """
+        # Get or create DB object - rows going through the writer are never read back
+        if not lookup or self.db.writer:
+            service = None
+        elif self.db_id:
             service = self.db.get_service(self.db_type, self.db_id)
 
             if not service:
@@ -58,19 +136,15 @@ class Service(object):
         else:
             service = self.db.get_service_by_identifier(self.db_type, self.identifier)
 
-        s = self.db.session
-
         if not service:
             service = self.db_type()
 
         service.name = self.name
         service.identifier = self.identifier
-        s.add(service)
-        s.commit()
+        return service
 
-        self.db_id = service.id
-
-        s.close()
+    def save(self):
+        self.db_id = self.db.store(self.db_object(), self.db_id)
 
     def add_user(self, user):
         self.users.append(user)
@@ -94,6 +168,14 @@ class Service(object):
         else:
             logger.debug("Chat {0} not in {1}".format(chat, self))
 
+    def find_user(self, identifier):
+        """ Return the user with this identifier if we already have one, without creating it """
+        for user in self.users:
+            if identifier == user.identifier:
+                return user
+
+        return None
+
     def user_by_identifier(self, identifier):
         for user in self.users:
             if identifier == user.identifier:
@@ -180,6 +262,9 @@ class Chat(object):
         )
 
     def _get_db_object(self) -> DBChat:
+        if self.db.writer:
+            return self.db_type()
+
         # Get or create DB object
         if self.db_id:
             chat = self.db.get_chat(self.db_type, self.db_id)
@@ -201,19 +286,12 @@ class Chat(object):
 
     @dbo.setter
     def dbo(self, value):
-        s = self.db.session
-        logger.debug(s)
-        s.add(value)
-        s.commit()
-        self.db_id = value.id
-        s.close()
+        self.db_id = self.db.store(value, self.db_id)
 
     def save(self):
         # Get or create DB object
         chat = self.dbo
 
-        s = self.db.session
-
         if not chat:
             chat = self.db_type()
 
@@ -232,12 +310,7 @@ class Chat(object):
                     ))
                     setattr(chat, attr, val)
 
-        s.add(chat)
-        s.commit()
-
-        self.db_id = chat.id
-
-        s.close()
+        self.dbo = chat
 
     async def get_chat_user(self, user):
         for chat_user in self.chat_users:
@@ -330,6 +403,9 @@ class User(object):
         self.save()
 
     def _get_db_object(self):
+        if self.db.writer:
+            return self.db_type()
+
         # Get or create DB object
         if self.db_id:
             user = self.db.get_user(self.db_type, self.db_id)
@@ -352,11 +428,7 @@ class User(object):
 
     @dbo.setter
     def dbo(self, value):
-        s = self.db.session
-        s.add(value)
-        s.commit()
-        self.db_id = value.id
-        s.close()
+        self.db_id = self.db.store(value, self.db_id)
 
     def save(self):
         user = self._get_db_object()
@@ -423,6 +495,9 @@ class ChatUser(object):
         return "{0}/{1}/{2}".format(self.service.name, self.chat.name, self.user.name)
 
     def _get_db_object(self):
+        if self.db.writer:
+            return self.db_type()
+
         # Get or create DB object
         if self.db_id:
             chat_user = self.db.get_chat_user(self.db_type, self.db_id)
@@ -445,11 +520,7 @@ class ChatUser(object):
 
     @dbo.setter
     def dbo(self, value):
-        s = self.db.session
-        s.add(value)
-        s.commit()
-        self.db_id = value.id
-        s.close()
+        self.db_id = self.db.store(value, self.db_id)
 
     @property
     def active(self):
@@ -537,6 +608,9 @@ class Message(object):
         return "{0}/{1}".format(self.service.id, self.ts)
 
     def _get_db_object(self):
+        if self.db.writer:
+            return self.db_type()
+
         # Get or create DB object
         if self.db_id:
             message = self.db.get_message(self.db_type, self.db_id)
@@ -583,11 +657,7 @@ class Message(object):
 
     @dbo.setter
     def dbo(self, value):
-        s = self.db.session
-        s.add(value)
-        s.commit()
-        self.db_id = value.id
-        s.close()
+        self.db_id = self.db.store(value, self.db_id)
 
     def __repr__(self):
         return "<{0}: {1}>".format(self.__class__.__name__, self.id)
@@ -628,13 +698,23 @@ class Event(object):
 
         self.db_id = None
 
-        self.save()
+        # Only events with a persist policy get a DB row - the rest are just
+        # counted, or only seen by subscribers
+        self.policy = service.bot.events.policy(event)
+
+        if self.policy == PERSIST:
+            self.save()
+
+        service.bot.events.publish(self)
 
     @property
     def id(self):
         return "{0}/{1}".format(self.service.id, self.ts)
 
     def _get_db_object(self):
+        if self.db.writer:
+            return self.db_type()
+
         # Get or create DB object
         if self.db_id:
             event = self.db.get_event(self.db_type, self.db_id)
@@ -684,11 +764,7 @@ class Event(object):
 
     @dbo.setter
     def dbo(self, value):
-        s = self.db.session
-        s.add(value)
-        s.commit()
-        self.db_id = value.id
-        s.close()
+        self.db_id = self.db.store(value, self.db_id)
 
     def __repr__(self):
         return "<{0}: {1}>".format(self.__class__.__name__, self.id)
@@ -778,11 +854,18 @@ class Bridge(object):
         else:
             self._name = str(uuid.uuid4())
 
+        # Only bridges given a name can be joined up with others (including
+        # across shards) - the rest are private to their one chat
+        self.named = name is not None
+
         self.enabled = enabled
 
         self.db_id = None
 
+        # Chats in this bridge (chat -> BridgeChat), and other listeners
+        # such as console sessions
         self.bridge_chats = {}
+        self.members = []
 
         self.logger.debug("New bridge {0} created.".format(self.name))
 
@@ -794,12 +877,13 @@ class Bridge(object):
 
     @name.setter
     def name(self, value):
-        self._name = value
-        self.save()
+        self.bot.rename_bridge(self, value)
 
     def save(self):
-        # Get or create DB object
-        if self.db_id:
+        # Get or create DB object - rows going through the writer are never read back
+        if self.db.writer:
+            bridge = None
+        elif self.db_id:
             bridge = self.db.get_bridge(self.db_id)
 
             if not bridge:
@@ -811,19 +895,12 @@ class Bridge(object):
         else:
             bridge = self.db.get_bridge_by_name(self.name)
 
-        s = self.db.session
-
         if not bridge:
             bridge = self.db_type()
 
         bridge.name = self.name
         bridge.enabled = self.enabled
-        s.add(bridge)
-        s.commit()
-
-        self.db_id = bridge.id
-
-        s.close()
+        self.db_id = self.db.store(bridge, self.db_id)
 
     def __del__(self):
         logger.debug("Deleting bridge {0}...".format(self.name))
@@ -835,12 +912,27 @@ class Bridge(object):
     def remove(self, member):
         self.members.remove(member)
 
-    async def send(self, message, exclude=None):
+    def add_bridge_chat(self, bridge_chat):
+        self.bridge_chats[bridge_chat.chat] = bridge_chat
+        self.bot.update_bridge_graph()
+
+    def remove_bridge_chat(self, bridge_chat):
+        if self.bridge_chats.get(bridge_chat.chat) is bridge_chat:
+            del self.bridge_chats[bridge_chat.chat]
+            self.bot.update_bridge_graph()
+
+    async def send(self, message, exclude=None, source=None):
+        for bridge_chat in list(self.bridge_chats.values()):
+            if exclude and (bridge_chat in exclude or bridge_chat.chat in exclude):
+                logger.debug("Excluding {0}...".format(bridge_chat.id))
+            else:
+                logger.debug("Sending text to {0}...".format(bridge_chat.id))
+                await bridge_chat.send(message, source)
+
         for member in self.members:
             if exclude and member in exclude:
                 logger.debug("Excluding {0}...".format(member.name))
             else:
-                logger.debug("Sending text to {0}...".format(member.name))
                 await member.send(message)
 
     async def receive(self, message, bridge_chat, chat_user):
@@ -851,42 +943,84 @@ class Bridge(object):
             message
         ))
 
-        if self.bot.source_format == 'short':
-            source_id = chat_user.user.name
-        else:
-            source_id = "{0}@{1}".format(chat_user.user.name, chat_user.chat.name)
-
-        #await self.send("<{0}> {1}".format(
-        #    source_id,
-        #    text
-        #), [chat])
+        # A repeat (e.g. looped back by another bridge bot) is neither
+        # relayed nor handed to plugins again
+        if self.bot.recent.seen(chat_user.id, message):
+            self.logger.debug("Suppressed duplicate message ({0})".format(self.bot.recent))
+            return
 
         await self.debugtools(message, bridge_chat, chat_user)
 
+        routes = self.bot.bridge_graph.routes.get(bridge_chat, ())
+
+        # Chats in this bridge on other shards
+        shard_client = self.bot.shard_client
+        remote = shard_client is not None and shard_client.has_routes(self, chat_user.chat)
+
+        if routes or self.members or remote:
+            relay = Relay(message, bridge_chat, chat_user, max_hops=self.bot.max_hops)
+            await self.relay(relay, routes)
+
+            if remote:
+                shard_client.relay(self, relay)
+
+    async def relay(self, relay, routes):
+        """ Send a relayed message out on its precomputed routes
+
+        Each distinct rendering (by destination type and format) is made once
+        and shared by every route that needs it.
+        """
+        user, chat = relay.chat_user.user, relay.chat_user.chat
+        rendered = {}
+
+        for route in routes:
+            if not relay.reaches(route.hops):
+                self.logger.debug("{0} is more than {1} hops away, not relaying".format(route.bridge_chat.id, relay.max_hops))
+                continue
+
+            if not relay.visit(route.bridge_chat.chat):
+                self.logger.debug("{0} already has this message, not relaying".format(route.bridge_chat.id))
+                continue
+
+            text = rendered.get(route.render_key)
+
+            if text is None:
+                text = rendered[route.render_key] = route.render(route.source_format, user.name, chat.name, relay.text)
+
+            relay.hops = max(relay.hops, relay.base_hops + route.hops)
+            await route.send(text)
+
+        # Console sessions listening in
+        for member in self.members:
+            await member.send("<{0}@{1}> {2}".format(user.name, chat.name, relay.text))
+
     async def debugtools(self, message, bridge_chat, chat_user):
-        recent_message = "{0}/{1}".format(chat_user.id, message)
+        dispatcher = self.bot.dispatcher
 
-        if self.bot.recent.get(recent_message):
-            self.logger.debug("Suppressed duplicate message")
-        else:
-            if message[0] == self.bot.prefix:
-                command, arg = re.match("(\S+)\s?(.*)", message[1:]).groups()
-                args = arg.split()
+        if message.startswith(self.bot.prefix):
+            command = dispatcher.command(message)
 
-                if command in self.bot.commands:
-                    self.logger.debug("Found command {0}".format(command))
-                    await self.bot.commands[command](args, bridge_chat, chat_user, message)
+            if command:
+                command, handler, args = command
+                self.logger.debug("Found command {0}".format(command))
 
-            else:
-                # Check matches
-                for match in self.bot.matches:
-                    if re.match(match, message):
-                        self.logger.debug("Regex match on {0} for {1}".format(
-                            match, message
-                        ))
-                        await self.bot.matches[match](None, bridge_chat, chat_user, message)
+                # Scheduled under the plugin's own name and settings, so a
+                # placeholder is swapped for the real handler first
+                handler = self.bot.resolve_handler(handler)
+
+                if handler:
+                    self.bot.scheduler.submit(handler, args, bridge_chat, chat_user, message)
+
+        else:
+            # Check matches
+            for match, handler in dispatcher.matching(message):
+                self.logger.debug("Regex match on {0} for {1}".format(
+                    match, message
+                ))
+                handler = self.bot.resolve_handler(handler)
 
-            self.bot.recent[recent_message] = True
+                if handler:
+                    self.bot.scheduler.submit(handler, None, bridge_chat, chat_user, message)
 
 
     def __repr__(self):
@@ -917,11 +1051,16 @@ class BridgeChat(object):
 
         self.save()
 
+        bridge.add_bridge_chat(self)
+
     @property
     def id(self):
         return "{0}/{1}".format(self.bridge.name, self.chat.name)
 
     def _get_db_object(self):
+        if self.db.writer:
+            return self.db_type()
+
         # Get or create DB object
         if self.db_id:
             bridge_chat = self.db.get_bridge_chat(self.db_type, self.db_id)
@@ -944,11 +1083,7 @@ class BridgeChat(object):
 
     @dbo.setter
     def dbo(self, value):
-        s = self.db.session
-        s.add(value)
-        s.commit()
-        self.db_id = value.id
-        s.close()
+        self.db_id = self.db.store(value, self.db_id)
 
     @property
     def active(self):
@@ -992,8 +1127,8 @@ class BridgeChat(object):
 
         self.dbo = bridge_chat
 
-    async def send(self, message):
-        await self.chat.send(message)
+    async def send(self, message, source=None):
+        await self.chat.send(self.chat.service.translate_out(message, source))
 
     async def receive(self, message, chat_user):
         await self.bridge.receive(message, self, chat_user)
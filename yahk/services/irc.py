@@ -2,12 +2,24 @@ from yahk.services import Service, Chat, User, ChatUser, Message, Event, BridgeC
 from yahk.db.irc import DBIRCService, DBIRCChat, DBIRCUser, DBIRCChatUser, DBIRCMessage, DBIRCEvent, DBIRCBridgeChat
 from asyncirc.protocol import IrcProtocol
 from asyncirc.server import Server
+import asyncio
 import logging
 
 # Set up logging
 logger = logging.getLogger(__name__)
 logger.debug("Loading IRC services...")
 
+# RFC 1459 casemapping, the default for most networks - []\~ are the
+# uppercase forms of {}|^
+irc_casefold = str.maketrans('ABCDEFGHIJKLMNOPQRSTUVWXYZ[]\\~', 'abcdefghijklmnopqrstuvwxyz{}|^')
+
+def irc_lower(name):
+    return name.translate(irc_casefold)
+
+# Replies to a JOIN we sent that mean we won't be joining: no such channel,
+# too many channels, full, invite only, banned, bad key, registration needed
+join_errors = ('403', '405', '471', '473', '474', '475', '477')
+
 class IRC(Service):
 
     db_type = DBIRCService
@@ -18,13 +30,18 @@ class IRC(Service):
     db_event_type = DBIRCEvent
     db_bridge_chat_type = DBIRCBridgeChat
 
+    service_type = 'irc'
+
     class IRCChat(Chat):
 
         def __init__(self, service, name, topic=None):
             self.db_type = service.db_chat_type
             self._topic = topic
             self.child_attrs = ['topic']
-            super().__init__(service, name)
+
+            # Known by the casefolded name, as servers don't always send it
+            # back in the case we asked for
+            super().__init__(service, irc_lower(name), name)
 
 
         @property
@@ -41,7 +58,11 @@ class IRC(Service):
             self.service.conn.send("JOIN {}".format(self.name))
 
         async def send(self, message):
-            self.service.conn.send("PRIVMSG {0} :{1}".format(self.name, message))
+            # One PRIVMSG per line - a newline would end the command early
+            for line in message.splitlines():
+                if line:
+                    self.service.remember_sent(self.identifier, line)
+                    self.service.conn.send("PRIVMSG {0} :{1}".format(self.name, line))
 
         async def receive(self, message, chat_user):
             # Build context
@@ -177,7 +198,7 @@ class IRC(Service):
             super().__init__(service, 'user_nick', user=user, new_value=new_nick, old_value=user.name)
 
 
-    def __init__(self, bot, id, name, enabled, hosts, nick, real_name, channels):
+    def __init__(self, bot, id, name, enabled, hosts, nick, real_name, channels, join_batch=10):
         self.chat_class = self.IRCChat
         self.user_class = self.IRCUser
         self.chat_user_class = self.IRCChatUser
@@ -193,6 +214,14 @@ class IRC(Service):
         self.nick = nick
         self.real_name = real_name
         self.channels = channels
+        self.join_batch = join_batch
+        self.pending_joins = set()
+
+        # Set by create(), once the service is started
+        self.conn = None
+
+        # The nick we actually have, which may not be the one we asked for
+        self.current_nick = nick
 
         self.logger.info("Initialising IRC server {0}".format(id))
         self.logger.debug("{0}: hosts: {1}, nick: {2}, realname: {3}".format(
@@ -213,6 +242,16 @@ class IRC(Service):
             realname=self.real_name,
             logger=self.logger
         )
+        # asyncirc reconnects (cycling through hosts) by itself - we just
+        # need to know when it happens
+        protocol_connection_lost = self.conn.connection_lost
+
+        def connection_lost(exc):
+            protocol_connection_lost(exc)
+            self.connection_lost(exc)
+
+        self.conn.connection_lost = connection_lost
+
         self.conn.register_cap('account-notify')
         self.conn.register('*', self.log)
         self.conn.register('001', self.connected)
@@ -227,6 +266,9 @@ class IRC(Service):
         self.conn.register('MODE', self.on_mode)
         self.conn.register('332', self.on_topicreply)
 
+        for numeric in join_errors:
+            self.conn.register(numeric, self.on_join_error)
+
     async def start(self):
         if self.enabled:
             await self.create()
@@ -235,19 +277,41 @@ class IRC(Service):
             self.logger.info("{0} is currently disabled".format(self.id))
             return
 
-    def connection_lost(self):
+    def connection_lost(self, exc=None):
         self.logger.debug("Connection lost.")
+        self.supervisor.down(exc)
+
+        # Chats are kept and rejoined on reconnect
+        for chat in self.chats.values():
+            chat.joined = False
 
     async def connected(self, conn, message):
         self.logger.info("Connected!")
 
-        # Join configured channels, and create/register with bridges
+        # 001 is addressed to whatever nick the server gave us
+        self.current_nick = message.parameters[0]
+
+        # Create/register chats with bridges first, so whatever case the
+        # server sends the names back in finds them - yielding between each
+        # so other services can make progress
         for channel in self.channels:
-            self.logger.debug("Joining channel {0}...".format(channel['name']))
-            await self.create_chat(channel)
+            await self.create_chat(channel, join=False)
+            await asyncio.sleep(0)
 
-    async def create_chat(self, channel):
-        chat = self.IRCChat(self, channel['name'])
+        # Then send all the JOINs, batched
+        names = [channel['name'] for channel in self.channels]
+        self.pending_joins = {irc_lower(name) for name in names}
+
+        for i in range(0, len(names), self.join_batch):
+            batch = names[i:i + self.join_batch]
+            self.logger.debug("Joining channels {0}...".format(', '.join(batch)))
+            self.conn.send("JOIN {0}".format(','.join(batch)))
+
+        if not self.pending_joins:
+            self.mark_ready()
+
+    async def create_chat(self, channel, join=True):
+        chat = await self.chat_from_name(channel['name'])
 
         #if 'bridges' not in channel:
         #    bridges = [None]
@@ -261,7 +325,8 @@ class IRC(Service):
         #    chat.bridges.append(bridge)
 
         #self.chats[chat.name] = chat
-        await chat.join()
+        if join:
+            await chat.join()
         #await chat.send("Hello {}!".format(chat.name))
 
     async def log(self, conn, message):
@@ -301,8 +366,8 @@ class IRC(Service):
     async def chat_from_name(self, name):
 
         # Check to see if the service has this chat already
-        if name in self.chats:
-            chat = self.chats[name]
+        if irc_lower(name) in self.chats:
+            chat = self.chats[irc_lower(name)]
             self.logger.debug("Found existing chat {0} in service".format(chat))
             return chat
 
@@ -315,28 +380,49 @@ class IRC(Service):
         chat, user, chat_user = await self.get_chat_and_user_from_message(message)
         self.logger.debug("{0} joined {1}".format(user.name, chat.name))
 
-        if user.name == self.nick:
+        if self.is_me(user.name):
             # This is us
             self.logger.debug("We've joined {0}".format(chat.name))
             await chat.query_users()
 
-            # TODO - fix
-            self.chats[chat.name].joined = True
+            # Our ident@host, as the server sees it
+            if self.me is not user:
+                self.me = user
+
+            chat.joined = True
+            self.join_done(chat.name)
         else:
             chat_user.active = True
 
         event = self.IRCJoinEvent(self, chat, user)
 
+    def join_done(self, name):
+        # The server may well send the name back in a different case
+        name = irc_lower(name)
+
+        if name in self.pending_joins:
+            self.pending_joins.discard(name)
+            if not self.pending_joins:
+                self.mark_ready()
+
+    async def on_join_error(self, conn, message):
+        channel = message.parameters[1]
+        self.logger.warning("Could not join {0}: {1}".format(
+            channel, ' '.join(message.parameters[2:]).lstrip(':')
+        ))
+
+        # Don't hold up readiness for a channel we're never going to be in
+        self.join_done(channel)
+
     async def on_part(self, conn, message):
         chat, user, chat_user = await self.get_chat_and_user_from_message(message)
         self.logger.debug("{0} left {1}".format(user.name, chat.name))
 
-        if user.name == self.nick:
+        if self.is_me(user.name):
             # This is us
             self.logger.debug("We've left {0}".format(chat.name))
 
-            # TODO - fix
-            self.chats[chat.name].joined = False
+            chat.joined = False
         else:
             chat_user.active = False
 
@@ -346,12 +432,11 @@ class IRC(Service):
         chat, user, chat_user = await self.get_chat_and_user_from_message(message)
         self.logger.debug("{0} left {1}".format(user.name, chat.name))
 
-        if user.name == self.nick:
+        if self.is_me(user.name):
             # This is us
             self.logger.debug("We've left {0}".format(chat.name))
 
-            # TODO - fix
-            self.chats[chat.name].joined = False
+            chat.joined = False
         else:
             chat_user.active = False
 
@@ -387,16 +472,43 @@ class IRC(Service):
         ))
 
         event = self.IRCNickEvent(self, user, new_nick)
+
+        if self.is_me(user.name):
+            self.current_nick = new_nick
+
         user.name = new_nick
 
 
+    def is_me(self, nick):
+        return irc_lower(nick) == irc_lower(self.current_nick)
+
+    def is_echo(self, message):
+        """ Whether a PRIVMSG is from us - or, if it has no user prefix, repeats something we just sent """
+        nick, ident, host = message.prefix
+        me = self.me
+
+        # Other clients (an operator, another bridge) may share our ident@host,
+        # so it only confirms a nick match
+        if ident or host:
+            if not self.is_me(nick):
+                return False
+
+            return not me or (ident == me.ident and host == me.host)
+
+        return self.sent_recently(irc_lower(message.parameters[0]), message.parameters[1][1:])
+
     async def on_privmsg(self, conn, message):
+        # Drop our own messages before creating or saving anything for them
+        if self.is_echo(message):
+            self.echoes += 1
+            return
+
         chat, user, chat_user = await self.get_chat_and_user_from_message(message)
         msg = self.IRCMessage(self, chat, user, message.parameters[1][1:])
 
         self.logger.debug("PRIVMSG received")
 
-        await self.chats[chat.name].receive(message, chat_user)
+        await chat.receive(message, chat_user)
 
     async def on_kick(self, conn, message):
         chat, user, chat_user = await self.get_chat_and_user_from_message(message)
@@ -433,5 +545,9 @@ class IRC(Service):
 
     async def quit(self):
         self.logger.debug("Quitting...")
-        self.conn.quit()
+        self.enabled = False
+
+        if self.conn:
+            self.conn.quit()
+
         self.logger.debug("Disconnected!")
\ No newline at end of file
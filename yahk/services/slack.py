@@ -1,12 +1,47 @@
 from yahk.services import Service, Chat, User, ChatUser, Message, Event, Bridge, BridgeChat
+from yahk.ratelimit import RateLimiter
+from yahk.dedupe import Deduplicator
+from yahk.events import PERSIST
 from yahk.db.slack import DBSlackService, DBSlackChat, DBSlackUser, DBSlackChatUser, DBSlackMessage, DBSlackEvent, DBSlackBridgeChat
 import asyncio
 import aiohttp
 import websockets
+import collections
+import hashlib
+import hmac
 import json
 import logging
+import re
+import time
+from aiohttp import web
 from itertools import count
 
+# Use a faster JSON decoder for RTM frames if one is installed
+try:
+    import orjson
+    json_loads = orjson.loads
+except ImportError:
+    try:
+        import ujson
+        json_loads = ujson.loads
+    except ImportError:
+        json_loads = json.loads
+
+# Slack puts the frame type first, so it can be read without decoding the frame
+frame_type_re = re.compile(r'\{\s*"type"\s*:\s*"([^"]+)"')
+
+# Slack markup in received text - user and channel references, special
+# mentions (<!here>), links, and the three characters Slack escapes
+slack_markup_re = re.compile(r'<([@#!]?)([^>|]*)(?:\|([^>]*))?>|&(amp|lt|gt);')
+
+# What becomes Slack markup in relayed text - a leading "nick:" (how people
+# are addressed on IRC), @mentions, and characters Slack needs escaped
+relay_markup_re = re.compile(r'^([\w\-\[\]\\`^{}|.]+)(?=[:,](?:\s|$))|@([\w\-\[\]\\`^{}|.]+)|([&<>])')
+
+slack_entities = {'amp': '&', 'lt': '<', 'gt': '>'}
+slack_escapes = {'&': '&amp;', '<': '&lt;', '>': '&gt;'}
+slack_escape_re = re.compile(r'[&<>]')
+
 
 # Set up logging
 logger = logging.getLogger(__name__)
@@ -22,65 +57,581 @@ class Slack(Service):
     db_event_type = DBSlackEvent
     db_bridge_chat_type = DBSlackBridgeChat
 
+    service_type = 'slack'
+
+    # Mentions are resolved against each workspace's own directory
+    render_per_service = True
+
+    directory_page_size = 200
+
+    # High-frequency RTM frames we have no use for
+    default_ignore_frames = [
+        'user_typing',
+        'presence_change',
+        'manual_presence_change',
+        'pong',
+        'reconnect_url',
+        'desktop_notification',
+        'dnd_updated_user'
+    ]
+
     class SlackAPI(object):
 
-        def __init__(self, service, token):
+        fatal_errors = ['invalid_auth', 'not_authed', 'account_inactive', 'token_revoked']
+
+        api_url = 'https://slack.com/api/{0}'
+
+        # HTTP connection pool settings
+        connection_limit = 20
+        keepalive_timeout = 60
+        dns_cache_ttl = 300
+        timeout = 30
+
+        # Read methods whose responses are cached, with their TTL in seconds
+        cached_methods = {
+            'users.info': 300,
+            'conversations.info': 300,
+            'auth.test': 60
+        }
+
+        # Errors worth remembering, so repeated lookups of something that
+        # doesn't exist don't each hit the API
+        negative_errors = ['channel_not_found', 'user_not_found', 'missing_scope']
+        negative_ttl = 60
+
+        cache_size = 10000
+
+        # Slack rate limit tiers (requests per minute), and the tier of each
+        # method we use - see https://api.slack.com/docs/rate-limits
+        tier_rates = {1: 1, 2: 20, 3: 50, 4: 100}
+        method_tiers = {
+            'rtm.start': 1,
+            'rtm.connect': 1,
+            'users.list': 2,
+            'conversations.list': 2,
+            'conversations.info': 3,
+            'users.info': 4,
+            'auth.test': 4
+        }
+
+        # Stay a little under the limits rather than bouncing off them
+        rate_headroom = 0.9
+
+        # chat.postMessage is limited to about one message a second per channel
+        post_message_rate = 1
+
+        # Lower goes first - sending messages beats directory lookups
+        method_priorities = {
+            'chat.postMessage': 0,
+            'chat.update': 0,
+            'chat.delete': 0,
+            'rtm.start': 1,
+            'rtm.connect': 1,
+            'auth.test': 1,
+            'users.list': 3,
+            'conversations.list': 3
+        }
+
+        max_retries = 3
+
+        # RTM send limits - longer messages, or ones with extra options
+        # (attachments, blocks, threading...) go over HTTP instead
+        rtm_max_length = 4000
+        ack_timeout = 10
+
+        def __init__(self, service, token, api_url=None):
             self.service = service
             self.token = token
             self._msg_id = count(1)
 
+            if api_url:
+                self.api_url = api_url
+
+            self.session = None
+            self.socket = None
+
+            self.limiter = RateLimiter(concurrency=self.connection_limit)
+
+            # Received frame counts by type
+            self.frames_since = None
+            self.frame_counts = collections.Counter()
+            self.frames_dropped = collections.Counter()
+
+            # Messages sent over RTM, waiting for their reply_to
+            self.pending_acks = {}
+            self.send_stats = {
+                'rtm': 0,
+                'http': 0,
+                'acked': 0,
+                'ack_time': 0.0,
+                'max_ack_time': 0.0
+            }
+
+            self.cache = {}
+            self.in_flight = {}
+            self.cache_stats = {
+                'hits': 0,
+                'negative_hits': 0,
+                'misses': 0,
+                'coalesced': 0
+            }
+
+        @property
+        def http(self) -> aiohttp.ClientSession:
+            # One long-lived session per service, so API calls reuse
+            # keep-alive connections instead of handshaking every time
+            if not self.session or self.session.closed:
+                connector = aiohttp.TCPConnector(
+                    limit=self.connection_limit,
+                    keepalive_timeout=self.keepalive_timeout,
+                    ttl_dns_cache=self.dns_cache_ttl
+                )
+                self.session = aiohttp.ClientSession(connector=connector)
+
+            return self.session
+
+        async def close(self):
+            if self.session and not self.session.closed:
+                self.service.logger.debug("Closing HTTP session...")
+                await self.session.close()
+
+            self.session = None
+
         async def api_call(self, method, data=None):
-            async with aiohttp.ClientSession() as session:
-                form = aiohttp.FormData(data or {})
-                form.add_field('token', self.token)
-
-                async with session.post('https://slack.com/api/{0}'.format(method),
-                    data=form) as response:
-                        self.service.logger.debug("Making API call to {0}...".format(method))
-                        if response.status != 200:
-                            self.service.logger.error("{0}: Failed to make API call to {1}".format(self.service.id, method))
-                            return False
-                        else:
-                            return await response.json()
+            if method not in self.cached_methods:
+                return await self._request(method, data)
+
+            key = (method, tuple(sorted((data or {}).items())))
+            entry = self.cache.get(key)
+
+            if entry and entry[0] > time.monotonic():
+                if entry[1] and entry[1]['ok']:
+                    self.cache_stats['hits'] += 1
+                else:
+                    self.cache_stats['negative_hits'] += 1
+                return entry[1]
+
+            # Single-flight - concurrent identical calls share one request
+            task = self.in_flight.get(key)
+
+            if task:
+                self.cache_stats['coalesced'] += 1
+            else:
+                self.cache_stats['misses'] += 1
+                task = asyncio.ensure_future(self._fetch(key, method, data))
+                self.in_flight[key] = task
+                task.add_done_callback(lambda t: self.in_flight.pop(key, None))
+
+            # Shielded, so one caller being cancelled doesn't fail the rest
+            return await asyncio.shield(task)
+
+        async def _fetch(self, key, method, data):
+            response = await self._request(method, data)
+
+            if response and response['ok']:
+                ttl = self.cached_methods[method]
+            elif response and 'error' in response and response['error'] in self.negative_errors:
+                ttl = self.negative_ttl
+            else:
+                return response
+
+            self.cache.pop(key, None)
+            self.cache[key] = (time.monotonic() + ttl, response)
+
+            if len(self.cache) > self.cache_size:
+                self._prune_cache()
+
+            return response
+
+        def _prune_cache(self):
+            now = time.monotonic()
+
+            for key in [key for key, (expires, _) in self.cache.items() if expires <= now]:
+                del self.cache[key]
+
+            # Still full of live entries - drop the oldest
+            while len(self.cache) > self.cache_size:
+                del self.cache[next(iter(self.cache))]
+
+        def invalidate(self, method, data=None):
+            self.cache.pop((method, tuple(sorted((data or {}).items()))), None)
+
+        def _rate_key(self, method, data):
+            """ Return the rate limiter bucket key for a call, creating its bucket """
+            if method == 'chat.postMessage':
+                # Limited per channel rather than per tier
+                key = (method, (data or {}).get('channel'))
+                self.limiter.bucket(key, self.post_message_rate, burst=3)
+                return key
+
+            tier = self.method_tiers.get(method, 3)
+            per_second = self.tier_rates[tier] * self.rate_headroom / 60
+            self.limiter.bucket(method, per_second, burst=max(1, int(self.tier_rates[tier] / 10)))
+            return method
+
+        async def _request(self, method, data=None):
+            key = self._rate_key(method, data)
+            priority = self.method_priorities.get(method, 2)
+
+            for attempt in range(self.max_retries + 1):
+                await self.limiter.acquire(key, priority)
+
+                try:
+                    status, retry_after, response = await self._post(method, data)
+                finally:
+                    self.limiter.release()
+
+                if status != 429:
+                    return response
+
+                # Rate limited anyway - hold back this method (everything queued
+                # behind it waits too) for as long as Slack asks, then retry
+                self.limiter.pause(key, retry_after)
+                self.service.logger.warning("Rate limited on {0}, retrying in {1}s".format(method, retry_after))
+
+            return {'ok': False, 'error': 'ratelimited'}
+
+        async def _post(self, method, data):
+            form = aiohttp.FormData(data or {})
+            form.add_field('token', self.token)
+
+            self.service.logger.debug("Making API call to {0}...".format(method))
+
+            try:
+                async with self.http.post(self.api_url.format(method), data=form,
+                                          timeout=aiohttp.ClientTimeout(total=self.timeout)) as response:
+                    if response.status == 429:
+                        return 429, int(response.headers.get('Retry-After', 1)), None
+                    elif response.status != 200:
+                        self.service.logger.error("{0}: Failed to make API call to {1} ({2})".format(
+                            self.service.id, method, response.status
+                        ))
+                        return response.status, None, {'ok': False, 'error': 'http_{0}'.format(response.status)}
+                    else:
+                        return 200, None, await response.json()
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                self.service.logger.error("{0}: Failed to make API call to {1}: {2}".format(self.service.id, method, e))
+                return None, None, {'ok': False, 'error': 'request_failed'}
 
         async def rtm_start(self):
             self.service.logger.debug("Connecting to Slack RTM websocket...")
             rtm = await self.api_call('rtm.start')
 
             if not rtm or 'url' not in rtm:
-                self.service.enabled = False
-                logger.error("{0}: Could not start Slack RTM session".format(self.service.id))
+                error = rtm['error'] if rtm and 'error' in rtm else None
+                logger.error("{0}: Could not start Slack RTM session ({1})".format(self.service.id, error))
+
+                # No point retrying with bad credentials
+                if error in self.fatal_errors:
+                    self.service.enabled = False
+
                 return False
 
-            async with aiohttp.ClientSession() as session:
-                async with session.ws_connect(rtm['url']) as ws:
-                    self.socket = ws
-                    async for msg in ws:
-                        try:
-                            self.service.logger.debug("{0}".format(msg.data))
-                            j = json.loads(msg.data)
-                            await self.service.receive(j)
-                            if j['type'] == 'message' and j['text'] == 'break':
-                                self.service.logger.debug("Break caught.")
-                                raise aiohttp.EofStream()
-                            if j['type'] == 'message' and j['text'] == 'bp':
-                                self.service.logger.debug("Break caught.")
-                        except aiohttp.EofStream:
-                            self.service.logger.info("Disconnected from Slack RTM stream.")
-                            return
-
-        def rtm_send(self, data):
-            self.socket.send_str(data)
-
-        def send_message(self, channel, text):
-            payload = {
-                'type': 'message',
-                'id': next(self._msg_id),
-                'channel': channel,
-                'text': text
+            async with self.http.ws_connect(rtm['url']) as ws:
+                self.socket = ws
+                try:
+                    await self._rtm_receive(ws)
+                finally:
+                    self.socket = None
+
+                    # Nothing more will be acknowledged on this socket
+                    for future, _ in self.pending_acks.values():
+                        if not future.done():
+                            future.set_result({'ok': False, 'error': 'disconnected'})
+                    self.pending_acks.clear()
+
+        async def _rtm_receive(self, ws):
+            self.frames_since = time.monotonic()
+            self.frame_counts.clear()
+            self.frames_dropped.clear()
+
+            async for msg in ws:
+                if msg.type != aiohttp.WSMsgType.TEXT:
+                    self.service.logger.debug("Non-text RTM frame: {0}".format(msg.type))
+                    continue
+
+                # Drop ignorable frames before paying for a full decode
+                m = frame_type_re.match(msg.data)
+                if m and m.group(1) in self.service.ignore_frames:
+                    self.frame_counts[m.group(1)] += 1
+                    self.frames_dropped[m.group(1)] += 1
+                    continue
+
+                # One bad frame shouldn't take the connection down with it
+                try:
+                    await self._rtm_frame(json_loads(msg.data))
+                except Exception as e:
+                    self.service.logger.exception("Failed to handle RTM frame: {0}".format(e))
+
+            self.service.logger.info("Disconnected from Slack RTM stream.")
+
+        async def _rtm_frame(self, j):
+            # Acknowledgement of something we sent
+            if 'reply_to' in j:
+                self.frame_counts['reply_to'] += 1
+                self._rtm_ack(j)
+                return
+
+            self.frame_counts[j.get('type')] += 1
+
+            # Our own messages come back to us - drop them here
+            if self.service.is_echo(j):
+                self.service.echoes += 1
+                return
+
+            await self.service.receive(j)
+
+        def frame_rates(self):
+            """ Frames per second by type since the RTM session started """
+            elapsed = time.monotonic() - self.frames_since if self.frames_since else 0
+
+            if not elapsed:
+                return {}
+
+            return {frame_type: count / elapsed for frame_type, count in self.frame_counts.items()}
+
+        def _rtm_ack(self, reply):
+            pending = self.pending_acks.pop(reply['reply_to'], None)
+
+            if not pending:
+                self.service.logger.debug("Unexpected reply {0}".format(reply))
+                return
+
+            future, sent = pending
+            latency = time.monotonic() - sent
+
+            self.send_stats['acked'] += 1
+            self.send_stats['ack_time'] += latency
+            self.send_stats['max_ack_time'] = max(self.send_stats['max_ack_time'], latency)
+
+            if not future.done():
+                future.set_result(reply)
+
+        async def rtm_send(self, data):
+            """ Send a frame over the RTM websocket, returning a future for its acknowledgement """
+            msg_id = next(self._msg_id)
+            data['id'] = msg_id
+
+            future = asyncio.get_event_loop().create_future()
+            self.pending_acks[msg_id] = (future, time.monotonic())
+
+            try:
+                await self.socket.send_str(json.dumps(data))
+            except Exception:
+                del self.pending_acks[msg_id]
+                raise
+
+            return future
+
+        def can_rtm_send(self, text, **options):
+            # RTM only carries plain text messages, up to a size limit
+            return self.socket is not None and not self.socket.closed and not options and \
+                len(text) <= self.rtm_max_length
+
+        async def send_message(self, channel, text, **options):
+            if self.can_rtm_send(text, **options):
+                try:
+                    ack = await self.rtm_send({
+                        'type': 'message',
+                        'channel': channel,
+                        'text': text
+                    })
+                except Exception as e:
+                    self.service.logger.warning("RTM send failed, falling back to HTTP: {0}".format(e))
+                else:
+                    self.send_stats['rtm'] += 1
+
+                    # The ack arrives on the same socket we may be handling a
+                    # frame from right now, so wait for it in the background
+                    return asyncio.ensure_future(self._wait_for_ack(ack, channel, text))
+
+            return await self._http_send(channel, text, **options)
+
+        async def _wait_for_ack(self, ack, channel, text):
+            try:
+                reply = await asyncio.wait_for(ack, self.ack_timeout)
+            except asyncio.TimeoutError:
+                # Might still have been delivered - don't risk sending it twice
+                self.service.logger.warning("No acknowledgement for message to {0}".format(channel))
+
+                for msg_id, (future, _) in list(self.pending_acks.items()):
+                    if future is ack:
+                        del self.pending_acks[msg_id]
+
+                return None
+
+            if reply['ok']:
+                return reply
+
+            self.service.logger.warning("RTM send to {0} failed ({1}), falling back to HTTP".format(
+                channel, reply['error'] if 'error' in reply else reply
+            ))
+
+            return await self._http_send(channel, text)
+
+        async def _http_send(self, channel, text, **options):
+            self.send_stats['http'] += 1
+            return await self.api_call('chat.postMessage', dict(options, channel=channel, text=text))
+
+    class EventsServer(object):
+
+        """ Receives Events API callbacks over HTTP instead of an RTM websocket
+
+        Each POST carries either a single event envelope, as Slack sends them,
+        or a JSON list of envelopes from a relay that batches them.  Requests
+        are acknowledged straight away and the batch is queued; one worker
+        feeds each batch through Slack.receive in order, so events are handled
+        by the same code as RTM frames.
+        """
+
+        path = '/slack/events'
+
+        # Signed requests older than this are refused, as Slack recommends
+        signature_max_age = 300
+
+        # Slack redelivers events it thinks we missed - remember event ids for
+        # long enough to drop the repeats
+        retry_window = 3600
+
+        def __init__(self, service, host='127.0.0.1', port=3000, path=None, signing_secret=None):
+            self.service = service
+            self.host = host
+            self.port = port
+            self.signing_secret = signing_secret
+
+            if path:
+                self.path = path
+
+            self.runner = None
+            self.worker = None
+            self.queue = asyncio.Queue()
+            self.seen = Deduplicator(window=self.retry_window)
+
+            self.stats = {
+                'batches': 0,
+                'events': 0,
+                'duplicates': 0,
+                'rejected': 0
             }
 
-            self.rtm_send(payload)
+        async def start(self):
+            app = web.Application()
+            app.router.add_post(self.path, self.handle)
+
+            self.runner = web.AppRunner(app)
+            await self.runner.setup()
+
+            site = web.TCPSite(self.runner, self.host, self.port)
+            await site.start()
+
+            # Port 0 means any free port - find out which one we got
+            if not self.port:
+                self.port = site._server.sockets[0].getsockname()[1]
+
+            self.worker = asyncio.ensure_future(self._work())
+            self.service.logger.info("Listening for Slack events on {0}:{1}{2}".format(self.host, self.port, self.path))
+
+        async def stop(self):
+            if self.worker:
+                self.worker.cancel()
+                self.worker = None
+
+            if self.runner:
+                await self.runner.cleanup()
+                self.runner = None
+
+        def verify(self, request, body):
+            """ Check a request's Slack signature against our signing secret """
+            timestamp = request.headers.get('X-Slack-Request-Timestamp')
+            signature = request.headers.get('X-Slack-Signature')
+
+            if not timestamp or not signature:
+                return False
+
+            try:
+                if abs(time.time() - int(timestamp)) > self.signature_max_age:
+                    return False
+            except ValueError:
+                return False
+
+            basestring = b'v0:' + timestamp.encode('ascii') + b':' + body
+            expected = 'v0=' + hmac.new(self.signing_secret.encode('utf-8'), basestring, hashlib.sha256).hexdigest()
+
+            return hmac.compare_digest(expected, signature)
+
+        async def handle(self, request):
+            body = await request.read()
+
+            if self.signing_secret and not self.verify(request, body):
+                self.stats['rejected'] += 1
+                self.service.logger.warning("Rejected unsigned or badly signed event request")
+                return web.Response(status=401)
+
+            try:
+                payload = json_loads(body)
+            except ValueError:
+                self.stats['rejected'] += 1
+                return web.Response(status=400)
+
+            if isinstance(payload, dict):
+                # Sent once, when the request URL is configured
+                if payload.get('type') == 'url_verification':
+                    return web.json_response({'challenge': payload.get('challenge')})
+
+                payload = [payload]
+
+            events = self.unwrap(payload)
+
+            if events:
+                self.stats['batches'] += 1
+                self.queue.put_nowait(events)
+
+            return web.Response(status=200)
+
+        def unwrap(self, envelopes):
+            """ Pull the events we want out of a list of Events API envelopes """
+            conn = self.service.conn
+            events = []
+
+            for envelope in envelopes:
+                if not isinstance(envelope, dict) or envelope.get('type') != 'event_callback':
+                    continue
+
+                event = envelope.get('event')
+
+                if not event:
+                    continue
+
+                if 'event_id' in envelope and self.seen.seen(envelope['event_id']):
+                    self.stats['duplicates'] += 1
+                    continue
+
+                event_type = event.get('type')
+                conn.frame_counts[event_type] += 1
+
+                if event_type in self.service.ignore_frames:
+                    conn.frames_dropped[event_type] += 1
+                    continue
+
+                if self.service.is_echo(event):
+                    self.service.echoes += 1
+                    continue
+
+                events.append(event)
+
+            return events
+
+        async def _work(self):
+            while True:
+                events = await self.queue.get()
+
+                for event in events:
+                    self.stats['events'] += 1
+
+                    try:
+                        await self.service.receive(event)
+                    except Exception as e:
+                        self.service.logger.exception("Failed to handle {0} event: {1}".format(event.get('type'), e))
 
     class SlackChat(Chat):
 
@@ -91,6 +642,14 @@ class Slack(Service):
             self._deleted = deleted
             self.child_attrs = ['topic', 'purpose', 'deleted']
 
+            # Use the prefetched directory if we have it
+            info = service.directory_chats.get(channel_id)
+
+            if info:
+                name = name or info['name']
+                self._topic = topic or info['topic']
+                self._purpose = purpose or info['purpose']
+
             if not name:
                 name = channel_id
 
@@ -98,8 +657,8 @@ class Slack(Service):
 
             super().__init__(service, channel_id, name)
 
-            self.service.bot.loop.create_task(self._conversations_info())
-            #self._conversations_info()
+            if not info:
+                self.service.bot.loop.create_task(self._conversations_info())
 
         @property
         def topic(self):
@@ -133,16 +692,13 @@ class Slack(Service):
         #
         async def send(self, message):
             #self.service.conn.send("PRIVMSG {0} :{1}".format(self.name, message))
-            await self.service.conn.api_call(
-                'chat.postMessage',
-                {'text': message,
-                 'channel': self.identifier}
-            )
+            self.service.remember_sent(self.identifier, message)
+            await self.service.conn.send_message(self.identifier, message)
 
 
         async def receive(self, message, chat_user):
             # Build context
-            text = message['text']
+            text = self.service.translate_in(message['text'])
             #chat = chat_user.chat
             #user = chat_user.user
 
@@ -155,14 +711,32 @@ class Slack(Service):
             #        await bridge.receive(text, self, name)
 
 
+        def update_from_directory(self, info):
+            # Only save if something actually changed
+            if info['name'] and info['name'] != self.name:
+                self.name = info['name']
+            if info['topic'] is not None and info['topic'] != self.topic:
+                self.topic = info['topic']
+            if info['purpose'] is not None and info['purpose'] != self.purpose:
+                self.purpose = info['purpose']
+
         async def _conversations_info(self):
+            # A directory load may be in progress and have this channel in it
+            await self.service.directory_ready.wait()
+
+            if self.identifier in self.service.directory_chats:
+                self.update_from_directory(self.service.directory_chats[self.identifier])
+                return
+
             response = await self.service.conn.api_call(
                 'conversations.info',
                 {'channel': self.identifier}
             )
 
-            if 'error' in response and response['error'] == 'channel_not_found':
-                self.logger.debug("Channel information not found for {0}".format(self.identifier))
+            if not response['ok']:
+                self.logger.debug("Channel information not found for {0}: {1}".format(
+                    self.identifier, response['error'] if 'error' in response else None
+                ))
                 return False
 
             self.name = response['channel']['name']
@@ -182,6 +756,11 @@ class Slack(Service):
         def __init__(self, service, user_id, name=None):
             self.db_type = service.db_user_type
 
+            info = service.directory_users.get(user_id)
+
+            if info:
+                name = name or info['name']
+
             if not name:
                 name = user_id
 
@@ -189,16 +768,69 @@ class Slack(Service):
 
             super().__init__(service, user_id, name)
 
-            self.service.bot.loop.create_task(self._users_info())
+            if not info:
+                self.service.bot.loop.create_task(self._users_info())
+
+        def update_from_directory(self, info):
+            if info['name'] and info['name'] != self.name:
+                self.name = info['name']
 
         async def _users_info(self):
+            await self.service.directory_ready.wait()
+
+            if self.identifier in self.service.directory_users:
+                self.update_from_directory(self.service.directory_users[self.identifier])
+                return
+
             response = await self.service.conn.api_call(
                 'users.info',
                 {'user': self.identifier}
             )
 
-            self.name = response['user']['name']
+            if not response['ok']:
+                self.logger.debug("User information not found for {0}: {1}".format(
+                    self.identifier, response['error'] if 'error' in response else None
+                ))
+                return False
+
+            info = self.service._user_info(response['user'])
+            self.service.index_user(self.identifier, info)
+            self.update_from_directory(info)
+
+
+    class SlackChatStub(object):
+
+        """ Stand-in for a channel nothing is bridged to
+
+        No DB rows, bridge or API calls - just enough to know we've seen the
+        channel.  Slack.materialize_chat() swaps it for a full SlackChat.
+        Until the directory has loaded, the last few messages are held, in
+        case it turns out to be a channel configured by name.
+        """
+
+        __slots__ = ('service', 'identifier', 'messages', 'held')
 
+        max_held = 20
+
+        def __init__(self, service, channel_id):
+            self.service = service
+            self.identifier = channel_id
+            self.messages = 0
+            self.held = None
+
+        def hold(self, message):
+            if self.held is None:
+                self.held = collections.deque(maxlen=self.max_held)
+
+            self.held.append(message)
+
+        @property
+        def name(self):
+            info = self.service.directory_chats.get(self.identifier)
+            return info['name'] if info and info['name'] else self.identifier
+
+        def __repr__(self):
+            return "<{0}: {1}>".format(self.__class__.__name__, self.identifier)
 
     class SlackChatUser(ChatUser):
 
@@ -247,6 +879,11 @@ class Slack(Service):
         def __init__(self, service, chat, user):
             super().__init__(service, 'user_left', chat=chat, user=user)
 
+    class SlackTypingEvent(SlackEvent):
+
+        def __init__(self, service, chat, user):
+            super().__init__(service, 'user_typing', chat=chat, user=user)
+
     class SlackInviteEvent(SlackEvent):
 
         def __init__(self, service, chat, user, invited_user):
@@ -254,7 +891,9 @@ class Slack(Service):
 
 
 
-    def __init__(self, bot, id, name, enabled, token, channels, team=None, team_id=None, url=None):
+    def __init__(self, bot, id, name, enabled, token, channels, team=None, team_id=None, url=None, api_url=None,
+                 ignore_frames=None, ingest='rtm', events_host='127.0.0.1', events_port=3000, events_path=None,
+                 signing_secret=None, lazy_chats=False):
         self.chat_class = self.SlackChat
         self.user_class = self.SlackUser
         self.chat_user_class = self.SlackChatUser
@@ -270,6 +909,51 @@ class Slack(Service):
         self._team_id = team_id
         self._url = url
         self.channels = channels
+        self.api_url = api_url
+        self.conn = None
+        self.me_bot_id = None
+
+        # With lazy_chats, channels that aren't configured only get a stub
+        # until a plugin needs them
+        self.lazy_chats = lazy_chats
+        self.chat_stubs = {}
+
+        # Where events come from - the RTM websocket, or Events API callbacks
+        self.ingest = ingest
+        self.events_host = events_host
+        self.events_port = events_port
+        self.events_path = events_path
+        self.signing_secret = signing_secret
+        self.events = None
+
+        # RTM frame dispatch
+        self.frame_handlers = {
+            'hello': self.on_hello,
+            'message': self.on_message_frame,
+            'user_typing': self.on_user_typing,
+            'member_joined_channel': self.on_user_join,
+            'member_left_channel': self.on_user_left,
+            'channel_created': self.on_channel_created,
+            'channel_deleted': self.on_channel_deleted,
+            'channel_rename': self.on_channel_rename,
+            'group_rename': self.on_channel_rename,
+            'user_change': self.on_user_change,
+            'team_join': self.on_user_change
+        }
+
+        self.message_subtype_handlers = {
+            'channel_topic': self.on_topic,
+            'channel_purpose': self.on_purpose
+        }
+
+        # Frame types dropped without decoding
+        self.ignore_frames = set(self.default_ignore_frames if ignore_frames is None else ignore_frames)
+
+        # Workspace directory, prefetched in bulk after connecting
+        self.directory_users = {}
+        self.directory_chats = {}
+        self.directory_names = {}
+        self.directory_ready = asyncio.Event()
 
         self.logger.info("Initialising Slack bot {0}".format(id))
 
@@ -311,7 +995,7 @@ class Slack(Service):
 
     async def create(self):
         # Create Slack connection
-        self.conn = self.SlackAPI(self, self.token)
+        self.conn = self.SlackAPI(self, self.token, api_url=self.api_url)
 
 
         # Event registration
@@ -321,13 +1005,88 @@ class Slack(Service):
     async def start(self):
         if self.enabled:
             await self.create()
-            while self.enabled:
-                await self.conn.rtm_start()
-                self.logger.warn("Connection to Slack RTM websocket closed.")
+
+            if self.ingest == 'events':
+                await self.start_events()
+            else:
+                # Chats and users stay cached on the service across reconnects
+                await self.supervisor.run(self.conn.rtm_start)
         else:
             logger.info("{0} is currently disabled".format(self.id))
             return
 
+    async def start_events(self):
+        self.events = self.EventsServer(
+            self, host=self.events_host, port=self.events_port, path=self.events_path,
+            signing_secret=self.signing_secret
+        )
+
+        try:
+            await self.events.start()
+        except OSError as e:
+            self.logger.error("Could not listen for Slack events: {0}".format(e))
+            self.supervisor.down(e)
+            return
+
+        self.conn.frames_since = time.monotonic()
+        await self.connected()
+
+    def stats(self):
+        stats = super().stats()
+
+        if self.lazy_chats:
+            stats['chats'] = "{0} full, {1} stubs".format(len(self.chats), len(self.chat_stubs))
+
+        if self.conn:
+            cache_stats = self.conn.cache_stats
+            lookups = sum(cache_stats.values())
+            stats['api cache'] = "{0} hits, {1} negative hits, {2} misses, {3} coalesced ({4:.1%} hit rate, {5} entries)".format(
+                cache_stats['hits'], cache_stats['negative_hits'], cache_stats['misses'], cache_stats['coalesced'],
+                (lookups - cache_stats['misses']) / lookups if lookups else 0.0, len(self.conn.cache)
+            )
+
+            limiter_stats = self.conn.limiter.stats()
+            stats['api rate limits'] = "{0} in flight, {1} queued, {2} sent, {3} throttled".format(
+                limiter_stats['active'], limiter_stats['waiting'], limiter_stats['granted'], limiter_stats['throttled']
+            )
+
+            send_stats = self.conn.send_stats
+            stats['sends'] = "{0} via RTM ({1} acked, {2:.1f}ms mean / {3:.1f}ms max ack), {4} via HTTP".format(
+                send_stats['rtm'], send_stats['acked'],
+                send_stats['ack_time'] / send_stats['acked'] * 1000 if send_stats['acked'] else 0.0,
+                send_stats['max_ack_time'] * 1000, send_stats['http']
+            )
+
+            rates = self.conn.frame_rates()
+            if rates:
+                stats['frames/s'] = ', '.join('{0}: {1:.2f}{2}'.format(
+                    frame_type, rate, ' (dropped)' if frame_type in self.conn.frames_dropped else ''
+                ) for frame_type, rate in sorted(rates.items(), key=lambda x: x[1], reverse=True))
+
+        if self.events:
+            events_stats = self.events.stats
+            stats['events api'] = "{0} batches, {1} events handled, {2} queued, {3} duplicates, {4} rejected".format(
+                events_stats['batches'], events_stats['events'], self.events.queue.qsize(),
+                events_stats['duplicates'], events_stats['rejected']
+            )
+
+        return stats
+
+    async def quit(self):
+        self.logger.debug("Quitting...")
+        self.enabled = False
+
+        if self.events:
+            await self.events.stop()
+
+        if self.conn:
+            if self.conn.socket:
+                await self.conn.socket.close()
+
+            await self.conn.close()
+
+        self.logger.debug("Disconnected!")
+
     async def _auth_test(self):
         response = await self.conn.api_call('auth.test')
 
@@ -336,6 +1095,94 @@ class Slack(Service):
 
         return response
 
+    async def _paginate(self, method, key, data=None):
+        """ Yield every item under key from a cursor-paginated API method """
+        cursor = None
+
+        while True:
+            params = dict(data or {}, limit=str(self.directory_page_size))
+            if cursor:
+                params['cursor'] = cursor
+
+            response = await self.conn.api_call(method, params)
+
+            if not response or not response['ok']:
+                self.logger.error("Could not page through {0}: {1}".format(
+                    method, response['error'] if response and 'error' in response else response
+                ))
+                return
+
+            for item in response[key]:
+                yield item
+
+            cursor = response.get('response_metadata', {}).get('next_cursor')
+            if not cursor:
+                return
+
+    @staticmethod
+    def _user_info(user):
+        profile = user['profile'] if 'profile' in user else {}
+
+        return {
+            'name': user['name'],
+            'display_name': profile.get('display_name') or profile.get('real_name') or user['name']
+        }
+
+    def index_user(self, user_id, info):
+        """ Add or update a user in the directory and its name lookup """
+        old = self.directory_users.get(user_id)
+
+        if old:
+            for name in (old['name'], old['display_name']):
+                if self.directory_names.get(name.lower()) == user_id:
+                    del self.directory_names[name.lower()]
+
+        self.directory_users[user_id] = info
+
+        # Usernames win over display names, which needn't be unique
+        self.directory_names.setdefault(info['display_name'].lower(), user_id)
+        self.directory_names[info['name'].lower()] = user_id
+
+    @staticmethod
+    def _chat_info(channel):
+        return {
+            'name': channel['name'] if 'name' in channel else None,
+            'topic': channel['topic']['value'] if 'topic' in channel else None,
+            'purpose': channel['purpose']['value'] if 'purpose' in channel else None
+        }
+
+    async def load_directory(self):
+        """ Fetch all users and channels in a handful of paged calls
+
+        Replaces thousands of individual users.info/conversations.info calls;
+        those are now only made for objects the directory didn't include.
+        """
+        start = time.monotonic()
+
+        try:
+            async for user in self._paginate('users.list', 'members'):
+                self.index_user(user['id'], self._user_info(user))
+
+            async for channel in self._paginate('conversations.list', 'channels',
+                                                {'types': 'public_channel,private_channel'}):
+                self.directory_chats[channel['id']] = self._chat_info(channel)
+        finally:
+            self.directory_ready.set()
+            await self.release_held()
+
+        # Bring anything created before the directory arrived up to date
+        for user in self.users:
+            if user.identifier in self.directory_users:
+                user.update_from_directory(self.directory_users[user.identifier])
+
+        for chat in list(self.chats.values()):
+            if chat.identifier in self.directory_chats:
+                chat.update_from_directory(self.directory_chats[chat.identifier])
+
+        self.logger.info("Loaded directory of {0} users and {1} channels in {2:.1f}s".format(
+            len(self.directory_users), len(self.directory_chats), time.monotonic() - start
+        ))
+
     async def chat_from_message(self, message):
         if not 'channel' in message:
             self.logger.error("No channel key in message")
@@ -355,60 +1202,122 @@ class Slack(Service):
         return u
 
     async def receive(self, data):
-        self.logger.debug(data)
+        handler = self.frame_handlers.get(data.get('type'))
 
-        if data['type'] == 'hello':
-            self.logger.debug("Got hello from Slack RTM API")
+        if handler:
+            await handler(data)
+        else:
+            self.logger.debug("Unhandled frame: {0}".format(data))
 
-            # Request info about ourselves
-            response = await self._auth_test()
+    async def on_message_frame(self, data):
+        if 'subtype' in data:
+            handler = self.message_subtype_handlers.get(data['subtype'])
 
-            if not response:
-                self.logger.error("Could not retrieve information about ourselves from the Slack API!")
-            else:
-                url = response['url']
-                team = response['team']
-                team_id = response['team_id']
-                user_name = response['user']
-                user_id = response['user_id']
+            if handler:
+                await handler(data)
+        else:
+            await self.on_message(data)
 
-                user = self.user_by_identifier(user_id)
-                user.name = user_name
+    async def on_hello(self, data):
+        self.logger.debug("Got hello from Slack RTM API")
+        await self.connected()
 
-                self.team = team
-                self.team_id = team_id
-                self.url = url
+    async def connected(self):
+        # Request info about ourselves
+        response = await self._auth_test()
 
-                self.me = user
+        if not response:
+            self.logger.error("Could not retrieve information about ourselves from the Slack API!")
+        else:
+            url = response['url']
+            team = response['team']
+            team_id = response['team_id']
+            user_name = response['user']
+            user_id = response['user_id']
 
-                self.logger.debug("Team is {0} ({1})".format(team, team_id))
-                self.logger.debug("URL is {0}".format(url))
-                self.logger.debug("We are {0} ({1})".format(user_name, user_id))
+            user = self.user_by_identifier(user_id)
+            user.name = user_name
 
-        if data['type'] == 'message':
-            if 'subtype' in data:
-                if data['subtype'] == 'channel_topic':
-                    await self.on_topic(data)
-                elif data['subtype'] == 'channel_purpose':
-                    await self.on_purpose(data)
+            self.team = team
+            self.team_id = team_id
+            self.url = url
 
-            else:
-                await self.on_message(data)
+            self.me = user
+            self.me_bot_id = response.get('bot_id')
+
+            self.logger.debug("Team is {0} ({1})".format(team, team_id))
+            self.logger.debug("URL is {0}".format(url))
+            self.logger.debug("We are {0} ({1})".format(user_name, user_id))
+
+        if not self.directory_ready.is_set():
+            self.bot.loop.create_task(self.load_directory())
+
+        self.mark_ready()
+
+    def is_echo(self, data):
+        """ Whether a message frame is one of ours, by user/bot id - or by content, if it has neither """
+        if data.get('type') != 'message':
+            return False
+
+        me = self.me
+
+        if 'user' in data or 'bot_id' in data:
+            return bool(me and data.get('user') == me.identifier) or \
+                bool(self.me_bot_id and data.get('bot_id') == self.me_bot_id)
+
+        # Only frames without a sender are matched on content, so a user
+        # repeating what we said isn't mistaken for us
+        return 'text' in data and self.sent_recently(data.get('channel'), data['text'])
 
-        if data['type'] == 'user_typing':
-            await self.on_user_typing(data)
+    def translate_in(self, text):
+        """ Replace Slack markup with plain text, e.g. <@U123> with @name """
+        return slack_markup_re.sub(self._plain_markup, text)
 
-        if data['type'] == 'member_left_channel':
-            await self.on_user_join(data)
+    def _plain_markup(self, m):
+        sigil, target, label, entity = m.groups()
 
-        if data['type'] == 'member_joined_channel':
-            await self.on_user_left(data)
+        if entity:
+            return slack_entities[entity]
 
-        if data['type'] == 'channel_created':
-            await self.on_channel_created(data)
+        if sigil == '@':
+            info = self.directory_users.get(target)
+            return '@{0}'.format(info['display_name'] if info else label or target)
 
-        if data['type'] == 'channel_deleted':
-            await self.on_channel_deleted(data)
+        if sigil == '#':
+            info = self.directory_chats.get(target)
+            return '#{0}'.format(label or (info['name'] if info else target))
+
+        if sigil == '!':
+            # <!here>, <!channel>, <!subteam^S123|@team>
+            return label or '@{0}'.format(target.split('^')[0])
+
+        # Links
+        if label and label != target:
+            return '{0} ({1})'.format(label, target)
+        return target
+
+    def translate_out(self, text, source=None):
+        """ Turn relayed nicks into Slack mentions, and escape the rest """
+        if source is None:
+            return text
+
+        return relay_markup_re.sub(self._slack_markup, text)
+
+    def escape_out(self, text):
+        return slack_escape_re.sub(lambda m: slack_escapes[m.group(0)], text)
+
+    def _slack_markup(self, m):
+        nick, mention, special = m.groups()
+
+        if special:
+            return slack_escapes[special]
+
+        user_id = self.directory_names.get((nick or mention).lower())
+
+        if not user_id:
+            return m.group(0)
+
+        return '<@{0}>'.format(user_id)
 
     async def get_chat_and_user_from_message(self, message):
         chat = await self.chat_from_message(message)
@@ -417,15 +1326,92 @@ class Slack(Service):
 
         return chat, user, chat_user
 
+    def is_lazy(self, channel_id):
+        """ Whether a channel should only be tracked as a stub for now """
+        if not self.lazy_chats or channel_id is None or channel_id in self.chats:
+            return False
+
+        if self.channels and channel_id in self.channels:
+            return False
+
+        # Handed back by the coordinator as a member of a bridge
+        shard_client = self.bot.shard_client
+
+        if shard_client and (self.id, channel_id) in shard_client.assignments:
+            return False
+
+        info = self.directory_chats.get(channel_id)
+
+        if self.channels and info and info['name'] and (
+                info['name'] in self.channels or '#' + info['name'] in self.channels):
+            return False
+
+        return True
+
+    def chat_stub(self, channel_id):
+        stub = self.chat_stubs.get(channel_id)
+
+        if not stub:
+            stub = self.SlackChatStub(self, channel_id)
+            self.chat_stubs[channel_id] = stub
+
+        return stub
+
+    async def release_held(self):
+        """ Once the directory is loaded, deliver held messages for channels that turned out to be configured """
+        for stub in list(self.chat_stubs.values()):
+            held, stub.held = stub.held, None
+
+            if held and not self.is_lazy(stub.identifier):
+                self.materialize_chat(stub.identifier)
+
+                for message in held:
+                    await self.on_message(message)
+
+    def materialize_chat(self, channel_id):
+        """ Turn a stub (or nothing) into a full chat """
+        stub = self.chat_stubs.pop(channel_id, None)
+
+        if stub:
+            self.logger.debug("Materialising {0} after {1} messages".format(stub.name, stub.messages))
+
+        return self.chat_by_identifier(channel_id)
+
     async def on_message(self, message):
+        if self.is_lazy(message.get('channel')):
+            stub = self.chat_stub(message['channel'])
+            stub.messages += 1
+
+            # Only worth a full chat if a plugin is going to act on this
+            if not self.bot.dispatcher.wants(self.translate_in(message.get('text') or '')):
+                # Until the directory is loaded we can't tell which channels
+                # were configured by name - keep these until we can
+                if self.channels and not self.directory_ready.is_set():
+                    stub.hold(message)
+                return
+
+            self.materialize_chat(message['channel'])
+
         chat, user, chat_user = await self.get_chat_and_user_from_message(message)
 
         await chat.receive(message, chat_user)
 
     async def on_user_typing(self, message):
-        chat, user, chat_user = await self.get_chat_and_user_from_message(message)
+        if self.bot.events.policy('user_typing') == PERSIST:
+            chat, user, chat_user = await self.get_chat_and_user_from_message(message)
+        else:
+            # Not worth creating chats or users for - pass on what we already know
+            chat = self.chats.get(message.get('channel'))
+            user = self.find_user(message.get('user'))
+
+        event = self.SlackTypingEvent(self, chat, user)
 
     async def on_topic(self, message):
+        if self.is_lazy(message.get('channel')):
+            self.chat_stub(message['channel'])
+            self.update_directory_chat(message['channel'], topic=message['topic'])
+            return
+
         chat, user, chat_user = await self.get_chat_and_user_from_message(message)
         topic = message['topic']
 
@@ -433,10 +1419,15 @@ class Slack(Service):
             user.name, chat.name, topic
         ))
 
-        chat.topic = topic
         event = self.SlackTopicEvent(self, chat, user, topic)
+        self.update_directory_chat(chat.identifier, topic=topic)
 
     async def on_purpose(self, message):
+        if self.is_lazy(message.get('channel')):
+            self.chat_stub(message['channel'])
+            self.update_directory_chat(message['channel'], purpose=message['purpose'])
+            return
+
         chat, user, chat_user = await self.get_chat_and_user_from_message(message)
         purpose = message['purpose']
 
@@ -444,16 +1435,24 @@ class Slack(Service):
             user.name, chat.name, purpose
         ))
 
-        chat.purpose = purpose
         event = self.SlackPurposeEvent(self, chat, user, purpose)
+        self.update_directory_chat(chat.identifier, purpose=purpose)
 
     async def on_user_join(self, message):
+        if self.is_lazy(message.get('channel')):
+            self.chat_stub(message['channel'])
+            return
+
         chat, user, chat_user = await self.get_chat_and_user_from_message(message)
         chat_user.active = True
 
         event = self.SlackJoinEvent(self, chat, user)
 
     async def on_user_left(self, message):
+        if self.is_lazy(message.get('channel')):
+            self.chat_stub(message['channel'])
+            return
+
         chat, user, chat_user = await self.get_chat_and_user_from_message(message)
         chat_user.active = False
 
@@ -462,6 +1461,13 @@ class Slack(Service):
     async def on_channel_created(self, message):
         # Get the channel ID from the message
         channel_id = message['channel']['id']
+        self.directory_chats[channel_id] = self._chat_info(message['channel'])
+
+        if self.is_lazy(channel_id):
+            stub = self.chat_stub(channel_id)
+            self.logger.debug("New channel {0} created".format(stub.name))
+            return
+
         chat = self.chat_by_identifier(channel_id)
 
         # Get the user ID from the message
@@ -471,9 +1477,57 @@ class Slack(Service):
         self.logger.debug("New channel {0} created by {1}".format(chat.name, user.name))
 
     async def on_channel_deleted(self, message):
-        chat = await self.chat_from_message(message)
+        channel_id = message['channel']
+        self.directory_chats.pop(channel_id, None)
+        self.chat_stubs.pop(channel_id, None)
+        self.conn.invalidate('conversations.info', {'channel': channel_id})
+
+        chat = self.chats.get(channel_id)
+
+        if chat:
+            chat.deleted = True
+
+        self.logger.debug("Channel {0} deleted".format(chat.name if chat else channel_id))
+
+    async def on_channel_rename(self, message):
+        channel_id = message['channel']['id']
+        name = message['channel']['name']
+
+        self.logger.debug("Channel {0} renamed to {1}".format(channel_id, name))
+        self.update_directory_chat(channel_id, name=name)
+
+    async def on_user_change(self, message):
+        # Sent with the whole user object, for profile changes and new users
+        user_id = message['user']['id']
+        info = self._user_info(message['user'])
+
+        self.index_user(user_id, info)
+        self.conn.invalidate('users.info', {'user': user_id})
+
+        user = self.find_user(user_id)
+
+        if user:
+            user.update_from_directory(info)
+
+    def update_directory_chat(self, channel_id, **changes):
+        """ Apply changes to a channel's directory entry, and its chat if we have one """
+        info = self.directory_chats.get(channel_id)
+
+        if info:
+            info.update(changes)
+        else:
+            info = dict({'name': None, 'topic': None, 'purpose': None}, **changes)
+
+            # Only worth keeping once we know what it's called
+            if info['name']:
+                self.directory_chats[channel_id] = info
+
+        self.conn.invalidate('conversations.info', {'channel': channel_id})
+
+        chat = self.chats.get(channel_id)
 
-        self.logger.debug("Channel {0} deleted".format(chat.name))
+        if chat:
+            chat.update_from_directory(info)
 
     async def on_invite(self, message):
         chat = await self.chat_from_message(message)
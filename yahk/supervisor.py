@@ -0,0 +1,123 @@
+import asyncio
+import logging
+import random
+import time
+
+logger = logging.getLogger(__name__)
+
+class Supervisor(object):
+
+    """ Tracks connection health for a service and paces its reconnects
+
+    Services either hand their connect coroutine to run(), which reconnects
+    with exponential backoff and jitter whenever it returns or raises, or (if
+    their protocol library reconnects on its own) just report up()/down().
+    Either way, chats and users cached on the service are kept, so a reconnect
+    resumes with the existing objects rather than rebuilding them.
+    """
+
+    def __init__(self, service, base_delay=1, max_delay=300, stable_after=60):
+        self.service = service
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.stable_after = stable_after
+
+        self.state = 'idle'
+        self.attempt = 0
+        self.connections = 0
+        self.reconnects = 0
+        self.last_error = None
+
+        self.up_since = None
+        self.down_since = None
+        self._downtime = 0.0
+
+    def up(self):
+        now = time.monotonic()
+
+        if self.state == 'up':
+            return
+
+        # Downtime only counts once we've been connected at least once
+        if self.down_since is not None:
+            if self.connections:
+                self._downtime += now - self.down_since
+            self.down_since = None
+
+        if self.connections:
+            self.reconnects += 1
+            self.service.logger.info("Reconnected (reconnect #{0})".format(self.reconnects))
+
+        self.connections += 1
+        self.state = 'up'
+        self.up_since = now
+
+    def down(self, error=None):
+        now = time.monotonic()
+
+        if error:
+            self.last_error = error
+
+        if self.down_since is None:
+            self.down_since = now
+
+        if self.state == 'up':
+            self.service.logger.warning("Connection lost{0}".format(
+                ": {0}".format(error) if error else ""
+            ))
+
+            # Only back off from scratch if the last connection was stable
+            if now - self.up_since >= self.stable_after:
+                self.attempt = 0
+
+        self.state = 'down'
+
+    @property
+    def downtime(self):
+        if self.down_since is not None and self.connections:
+            return self._downtime + time.monotonic() - self.down_since
+        return self._downtime
+
+    def delay(self):
+        delay = min(self.max_delay, self.base_delay * 2 ** self.attempt)
+        return random.uniform(delay / 2, delay)
+
+    async def run(self, connect):
+        """ Call connect() until the service is disabled, backing off between attempts """
+        while self.service.enabled:
+            self.state = 'connecting'
+            error = None
+
+            try:
+                await connect()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                error = e
+                self.service.logger.error("Connection failed: {0}".format(e))
+
+            self.down(error)
+
+            if not self.service.enabled:
+                break
+
+            delay = self.delay()
+            self.attempt += 1
+            self.state = 'backoff'
+            self.service.logger.info("Reconnecting in {0:.1f}s (attempt {1})".format(delay, self.attempt))
+
+            await asyncio.sleep(delay)
+
+        self.state = 'stopped'
+
+    def stats(self):
+        return {
+            'state': self.state,
+            'connections': self.connections,
+            'reconnects': self.reconnects,
+            'downtime': self.downtime,
+            'last_error': self.last_error
+        }
+
+    def __repr__(self):
+        return "<{0}: {1} {2}>".format(self.__class__.__name__, self.service.id, self.state)